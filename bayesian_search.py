@@ -1,14 +1,54 @@
+import os
+import time
+
 import numpy as np
+from joblib import parallel_config
 
 from skopt import BayesSearchCV
 from skopt.space import Real, Integer
 
 from sklearn.ensemble import HistGradientBoostingRegressor
+from sklearn.experimental import enable_halving_search_cv  # noqa: F401
+from sklearn.model_selection import HalvingRandomSearchCV
 from sklearn.pipeline import Pipeline
 
 from create_Xy import get_data
 from data_augmentation import get_constructor
 
+# Compute the fold-independent features once instead of for every candidate
+# and fold, only the airport buckets are fitted per fold
+precompute_features = True
+# Store the precomputed features as a memory-mapped matrix that all fold
+# processes share instead of receiving a pickled copy of the frame
+shared_matrix = True
+matrix_path = "data/cache/search_features.npy"
+
+# Fold processes and OpenMP threads per process, together one per core
+n_jobs = min(10, os.cpu_count())
+threads_per_job = max(1, os.cpu_count() // n_jobs)
+cv = 10  # folds of the cross-validation
+
+# "bayes" trains every candidate to completion on all folds, "halving" trains
+# many candidates on few samples with early stopping and keeps the best third
+# for the next round with three times more samples
+search_mode = "bayes"
+halving_candidates = 81
+# Share of the training rows available to the last halving round, the search
+# is repeated for each budget to compare wall-clock time and best RMSE
+halving_budgets = [0.1, 0.3, 1.0]
+
+
+class Sampled:
+    """
+    Draws single values of a skopt dimension, as sklearn's samplers expect
+    """
+
+    def __init__(self, dimension):
+        self.dimension = dimension
+
+    def rvs(self, random_state=None):
+        return self.dimension.rvs(random_state=random_state)[0]
+
 
 search_spaces = {
     "model__learning_rate": Real(0.01, 0.1),
@@ -23,7 +63,7 @@ search_spaces = {
 booster = HistGradientBoostingRegressor(
     random_state=42, categorical_features="from_dtype", max_bins=255
 )
-constructor = get_constructor("tabular")
+constructor = get_constructor("tabular", precomputed=precompute_features)
 pipeline = Pipeline(
     [
         ("feature_union", constructor),
@@ -33,18 +73,105 @@ pipeline = Pipeline(
 data = get_data("challenge_set")
 X = data.drop("tow", axis=1)
 y = data["tow"]
+if precompute_features:
+    X = constructor.features(X)
+    if shared_matrix:
+        os.makedirs(os.path.dirname(matrix_path), exist_ok=True)
+        X, categorical, buckets = constructor.to_matrix(X, matrix_path)
+        booster.set_params(categorical_features=categorical)
+        pipeline = Pipeline(
+            [
+                ("feature_union", buckets),
+                ("model", booster),
+            ]
+        )
+
 
-random_search = BayesSearchCV(
-    estimator=pipeline,  # The pipeline to tune
-    search_spaces=search_spaces,  # The hyperparameter search space
-    n_iter=50,  # Number of iterations
-    cv=10,  # 10-fold cross-validation
-    n_jobs=-1,  # Use all available cores
-    verbose=2,  # Verbosity level
-    random_state=42,  # Set random seed for reproducibility
-)
 np.int = int  # Fix for skopt bug
-random_search.fit(X, y)
+if search_mode == "bayes":
+    random_search = BayesSearchCV(
+        estimator=pipeline,  # The pipeline to tune
+        search_spaces=search_spaces,  # The hyperparameter search space
+        n_iter=50,  # Number of iterations
+        cv=cv,  # Folds of the cross-validation
+        n_jobs=n_jobs,  # Fold processes
+        verbose=2,  # Verbosity level
+        random_state=42,  # Set random seed for reproducibility
+    )
+    with parallel_config("loky", inner_max_num_threads=threads_per_job):
+        random_search.fit(X, y)
+
+    print(f"Best score: {random_search.best_score_}")
+    print(f"Best parameters: {random_search.best_params_}")
+elif search_mode == "halving":
+    # Stop boosting once the validation loss no longer improves, max_iter is
+    # only an upper bound
+    validation_fraction = 0.1
+    booster.set_params(early_stopping=True, validation_fraction=validation_fraction)
+    # Rows every round needs so that the booster can split at all, two leaves
+    # of the largest min_samples_leaf in the training folds after the
+    # validation split
+    fold_share = (cv - 1) / cv
+    min_samples = int(
+        np.ceil(
+            2
+            * search_spaces["model__min_samples_leaf"].high
+            / (fold_share * (1 - validation_fraction))
+        )
+    )
+    # The last round keeps a single candidate and uses the whole budget
+    rounds = int(np.ceil(np.log(halving_candidates) / np.log(3)))
+    for budget in halving_budgets:
+        max_resources = int(budget * len(X))
+        if max_resources < min_samples:
+            print(
+                f"Warning: budget {budget:.0%} has {max_resources} samples, "
+                f"fewer than the {min_samples} needed for a split, skipped"
+            )
+            continue
+        # Fewer rounds and candidates when the first round would be too small
+        budget_rounds = min(
+            rounds, int(np.floor(np.log(max_resources / min_samples) / np.log(3)))
+        )
+        n_candidates = min(halving_candidates, 3**budget_rounds)
+        if budget_rounds < rounds:
+            print(
+                f"Warning: budget {budget:.0%} allows {budget_rounds + 1} rounds "
+                f"of at least {min_samples} samples, searching {n_candidates} "
+                f"candidates instead of {halving_candidates}"
+            )
+        halving_search = HalvingRandomSearchCV(
+            estimator=pipeline,
+            param_distributions={
+                name: Sampled(dimension) for name, dimension in search_spaces.items()
+            },
+            n_candidates=n_candidates,
+            factor=3,
+            resource="n_samples",
+            min_resources=max_resources // 3**budget_rounds,
+            max_resources=max_resources,
+            scoring="neg_root_mean_squared_error",
+            cv=cv,
+            n_jobs=n_jobs,
+            random_state=42,
+        )
+        start = time.perf_counter()
+        with parallel_config("loky", inner_max_num_threads=threads_per_job):
+            halving_search.fit(X, y)
+        elapsed = time.perf_counter() - start
 
-print(f"Best score: {random_search.best_score_}")
-print(f"Best parameters: {random_search.best_params_}")
+        results = halving_search.cv_results_
+        for i in range(halving_search.n_iterations_):
+            in_round = results["iter"] == i
+            print(
+                f"    round {i}: {halving_search.n_candidates_[i]} candidates on "
+                f"{halving_search.n_resources_[i]} samples, best RMSE "
+                f"{-results['mean_test_score'][in_round].max():.1f}"
+            )
+        print(
+            f"Budget {budget:.0%}: {elapsed:.0f}s, "
+            f"best RMSE {-halving_search.best_score_:.1f}"
+        )
+        print(f"Best parameters: {halving_search.best_params_}")
+else:
+    raise ValueError(f"Unknown search mode {search_mode}")
@@ -0,0 +1,285 @@
+import functools
+import os
+import resource
+import sys
+import tempfile
+import time
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import ExitStack, contextmanager
+from multiprocessing import get_context
+from unittest import mock
+
+import numpy as np
+import pandas as pd
+
+from traffic.core import Flight
+
+import parquet_processor
+import trajectory.features
+
+days = 4
+flights_per_day = 200
+points_per_flight = 2000
+max_workers = None
+phase_method = "traffic"
+
+
+def synthetic_flights(n_flights: int, points: int, date="2022-01-01", seed=0):
+    """
+    Generate trajectories with taxi, climb, cruise, descent and landing in the
+    layout of the daily parquet files
+    :param n_flights: number of flights
+    :param points: number of points per flight
+    :param date: day of the flights
+    :param seed:
+    :return: dataframe
+    """
+    rng = np.random.default_rng(seed)
+    day = pd.Timestamp(date, tz="UTC")
+    flights = []
+    for i in range(n_flights):
+        duration = rng.uniform(45, 240) * 60  # s
+        t = np.sort(rng.uniform(0, duration, points))
+        cruise_alt = rng.choice([8000, 24000, 33000, 37000, 39000])
+        climb = min(cruise_alt / rng.uniform(1500, 3000) * 60, duration / 3)
+        descent = min(cruise_alt / rng.uniform(1000, 2000) * 60, duration / 3)
+        profile = [0, 300, 300 + climb, duration - 300 - descent, duration - 300]
+        altitude = np.interp(
+            t, profile + [duration], [0, 0] + [cruise_alt] * 2 + [0, 0]
+        )
+        groundspeed = np.interp(t, profile + [duration], [15, 160, 450, 450, 140, 15])
+
+        data = pd.DataFrame(
+            {
+                "flight_id": 248000000 + seed * 100000 + i,
+                "timestamp": day
+                + pd.Timedelta(minutes=rng.uniform(0, 1200))
+                + pd.to_timedelta(t, unit="s"),
+                "latitude": np.linspace(40, 55, points),
+                "longitude": np.linspace(-5, 20, points),
+                "altitude": altitude + rng.normal(0, 25, points),
+                "groundspeed": groundspeed + rng.normal(0, 3, points),
+                "track": rng.uniform(0, 360) + rng.normal(0, 1, points),
+                "vertical_rate": np.gradient(altitude, t) * 60
+                + rng.normal(0, 64, points),
+                "icao24": f"{i:06x}",
+                "u_component_of_wind": rng.normal(10, 5, points),
+                "v_component_of_wind": rng.normal(0, 5, points),
+                "temperature": 288.15 - 0.0019812 * altitude,
+                "specific_humidity": np.abs(rng.normal(0.004, 0.001, points)),
+            }
+        )
+        # Missing vertical rates, as in the real data
+        data.loc[rng.random(points) < 0.02, "vertical_rate"] = np.nan
+        flights.append(data)
+    return pd.concat(flights, ignore_index=True)
+
+
+def write_synthetic_days(root: str, n_days: int, n_flights: int, points: int):
+    """
+    Write synthetic daily parquet files and the matching flight list below root,
+    in the layout expected by parquet_processor
+    :param root: directory that takes the place of the repository root
+    :param n_days: number of days, starting on 2022-01-01
+    :param n_flights: number of flights per day
+    :param points: number of points per flight
+    :return: list of dates
+    """
+    os.makedirs(os.path.join(root, parquet_processor.parquet_path), exist_ok=True)
+    dates = pd.date_range(start="2022-01-01 00:00Z", periods=n_days).tolist()
+    flight_list = []
+    for seed, date in enumerate(dates):
+        date_str = date.strftime("%Y-%m-%d")
+        data = synthetic_flights(n_flights, points, date_str, seed)
+        data.to_parquet(
+            os.path.join(root, parquet_processor.parquet_path, date_str + ".parquet")
+        )
+        offblock = data.groupby("flight_id")["timestamp"].min()
+        flight_list.append(
+            pd.DataFrame(
+                {
+                    "flight_id": offblock.index,
+                    "actual_offblock_time": offblock.dt.strftime("%Y-%m-%dT%H:%M:%SZ"),
+                }
+            )
+        )
+    pd.concat(flight_list).to_csv(
+        os.path.join(root, parquet_processor.target_set), index=False
+    )
+    return dates
+
+
+@contextmanager
+def stage_timer():
+    """
+    Accumulate the time spent in the stages of the trajectory pipeline of this
+    process
+    :return: dict of stage to seconds
+    """
+    totals = defaultdict(float)
+
+    def timed(stage, fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                totals[stage] += time.perf_counter() - start
+
+        return wrapper
+
+    stages = [
+        (Flight, "compute_TAS", "TAS"),
+        (Flight, "phases", "phases"),
+        (trajectory.features, "label_phases", "phases"),
+        (Flight, "resample", "resample"),
+        (trajectory.features, "flight_kernel", "aggregation"),
+        (parquet_processor, "flight_kernel", "aggregation"),
+    ]
+    with ExitStack() as stack:
+        for owner, name, stage in stages:
+            stack.enter_context(
+                mock.patch.object(owner, name, timed(stage, getattr(owner, name)))
+            )
+        yield totals
+
+
+def peak_rss():
+    """
+    Peak resident set size of this process and of its finished children
+    :return: tuple of megabytes
+    """
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    unit = 1 if sys.platform == "darwin" else 1024
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * unit
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * unit
+    return own / 2**20, children / 2**20
+
+
+def bench_process_one_flight(root: str, date: str):
+    """
+    Run process_one_flight on every flight of a synthetic day
+    :param root:
+    :param date:
+    :return: dict with the number of flights, the wall-clock time and the stages
+    """
+    os.chdir(root)
+    data = pd.read_parquet(parquet_processor.parquet_path + date + ".parquet")
+    flights = [Flight(group) for _, group in data.groupby("flight_id")]
+    with stage_timer() as stages:
+        start = time.perf_counter()
+        for flight in flights:
+            parquet_processor.process_one_flight(flight)
+        seconds = time.perf_counter() - start
+    return {"flights": len(flights), "seconds": seconds, "stages": dict(stages)}
+
+
+def bench_process_daily_file(root: str, date: str, phase_method=phase_method):
+    """
+    Run process_daily_file on a synthetic day
+    :param root:
+    :param date:
+    :param phase_method:
+    :return: dict with the number of flights, the wall-clock time and the stages
+    """
+    os.chdir(root)
+    flights = parquet_processor.partition_flights()[date]
+    with stage_timer() as stages:
+        start = time.perf_counter()
+        parquet_processor.process_daily_file(
+            pd.Timestamp(date), flights, phase_method=phase_method
+        )
+        seconds = time.perf_counter() - start
+    return {"flights": len(flights), "seconds": seconds, "stages": dict(stages)}
+
+
+def bench_process_all_files(root: str, dates, phase_method=phase_method):
+    """
+    Run process_all_files on all synthetic days, the stages run in the workers
+    and are not split
+    :param root:
+    :param dates:
+    :param phase_method:
+    :return: dict with the number of flights and the wall-clock time
+    """
+    os.chdir(root)
+    start = time.perf_counter()
+    parquet_processor.process_all_files(
+        max_workers=max_workers, force=True, dates=dates, phase_method=phase_method
+    )
+    seconds = time.perf_counter() - start
+    flights = len(pd.read_csv(parquet_processor.target_set))
+    return {
+        "flights": flights,
+        "seconds": seconds,
+        "stages": {},
+        "peak_rss_workers": peak_rss()[1],
+    }
+
+
+def run_isolated(fn, *args, **kwargs):
+    """
+    Run a benchmark in a fresh process so that its peak memory is its own
+    :return: result of the benchmark with the peak RSS added
+    """
+    with ProcessPoolExecutor(1, mp_context=get_context("spawn")) as executor:
+        return executor.submit(measured, fn, *args, **kwargs).result()
+
+
+def measured(fn, *args, **kwargs):
+    result = fn(*args, **kwargs)
+    result["peak_rss"] = peak_rss()[0]
+    return result
+
+
+def report(name: str, result: dict):
+    """
+    Print flights per second, peak memory and the time split of a benchmark
+    :param name:
+    :param result:
+    """
+    print(
+        f"{name}: {result['flights']} flights in {result['seconds']:.2f}s, "
+        f"{result['flights'] / result['seconds']:.1f} flights/s, "
+        f"peak RSS {result['peak_rss']:.0f} MB"
+        + (
+            f" (workers {result['peak_rss_workers']:.0f} MB)"
+            if "peak_rss_workers" in result
+            else ""
+        )
+    )
+    stages = result["stages"]
+    if stages:
+        stages["other"] = max(result["seconds"] - sum(stages.values()), 0)
+        print(
+            "    "
+            + ", ".join(
+                f"{stage} {seconds / result['seconds']:.0%}"
+                for stage, seconds in stages.items()
+            )
+        )
+
+
+if __name__ == "__main__":
+    with tempfile.TemporaryDirectory() as root:
+        print(
+            f"Generating {days} days of {flights_per_day} flights "
+            f"with {points_per_flight} points"
+        )
+        dates = write_synthetic_days(root, days, flights_per_day, points_per_flight)
+        first = dates[0].strftime("%Y-%m-%d")
+
+        report(
+            "process_one_flight", run_isolated(bench_process_one_flight, root, first)
+        )
+        for method in ["traffic", "fast"]:
+            report(
+                f"process_daily_file ({method})",
+                run_isolated(bench_process_daily_file, root, first, method),
+            )
+        report(
+            f"process_all_files ({phase_method})",
+            run_isolated(bench_process_all_files, root, dates, phase_method),
+        )
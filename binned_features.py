@@ -0,0 +1,291 @@
+import copy
+import hashlib
+import os
+import pickle
+
+import numpy as np
+
+from sklearn.ensemble._hist_gradient_boosting._gradient_boosting import (
+    _update_raw_predictions,
+)
+from sklearn.ensemble._hist_gradient_boosting.common import G_H_DTYPE, Y_DTYPE
+from sklearn.ensemble._hist_gradient_boosting.grower import TreeGrower
+from sklearn.utils._openmp_helpers import _openmp_effective_n_threads
+from sklearn.utils.validation import _check_monotonic_cst
+
+from create_Xy import cache_key, cache_path, get_data
+
+
+def bin_flights(booster, Xt):
+    """
+    Bins flights with the encoders and bins of a fitted booster
+    :param booster: fitted HistGradientBoostingRegressor
+    :param Xt: flights transformed by the pipeline
+    :return: F-contiguous uint8 matrix
+    """
+    return booster._bin_mapper.transform(booster._preprocess_X(Xt, reset=False))
+
+
+def raw_predict(booster, X_binned, n_threads):
+    """
+    Raw predictions of all trees of the booster on binned flights
+    :param booster: fitted HistGradientBoostingRegressor
+    :param X_binned: uint8 matrix as returned by bin_flights
+    :param n_threads:
+    :return: array of raw predictions
+    """
+    missing = booster._bin_mapper.missing_values_bin_idx_
+    raw = np.full(len(X_binned), booster._baseline_prediction[0, 0], dtype=Y_DTYPE)
+    for (predictor,) in booster._predictors:
+        raw += predictor.predict_binned(X_binned, missing, n_threads)
+    return raw
+
+
+def clear_trees(booster, y):
+    """
+    Removes the trees of a fitted booster and sets its baseline prediction for
+    new takeoff weights, keeping its encoders and bins
+    :param booster: fitted HistGradientBoostingRegressor, modified in place
+    :param y: takeoff weights the trees are grown on next
+    """
+    booster._predictors = []
+    booster._baseline_prediction = booster._loss.fit_intercept_only(
+        y_true=np.asarray(y, dtype=Y_DTYPE)
+    ).reshape((1, -1))
+
+
+def add_trees(
+    booster,
+    X_binned,
+    y,
+    n_trees: int,
+    X_val=None,
+    y_val=None,
+    n_iter_no_change=10,
+    tol=0.0,
+):
+    """
+    Grows trees after those of a fitted booster with its parameters, encoders
+    and bins, which stay as they are. With validation flights, stops when their
+    RMSE has not improved for n_iter_no_change trees and keeps the trees up to
+    the best one
+    :param booster: fitted HistGradientBoostingRegressor, modified in place
+    :param X_binned: training flights as returned by bin_flights
+    :param y: takeoff weights of the training flights
+    :param n_trees: number of trees added at most
+    :param X_val: validation flights as returned by bin_flights
+    :param y_val: takeoff weights of the validation flights
+    :param n_iter_no_change: trees without improvement of the validation RMSE
+    :param tol: improvement of the validation RMSE that counts
+    :return: validation RMSE of the kept trees, None without validation flights
+    """
+    n_threads = _openmp_effective_n_threads()
+    loss = booster._loss
+    bin_mapper = booster._bin_mapper
+    y = np.ascontiguousarray(y, dtype=Y_DTYPE)
+    raw = raw_predict(booster, X_binned, n_threads)
+    gradient, hessian = loss.init_gradient_and_hessian(
+        n_samples=len(y), dtype=G_H_DTYPE, order="F"
+    )
+    has_missing_values = (
+        (X_binned == bin_mapper.missing_values_bin_idx_).any(axis=0).astype(np.uint8)
+    )
+    # The booster puts the categorical features first
+    monotonic_cst = _check_monotonic_cst(booster, booster.monotonic_cst)
+    if booster.is_categorical_ is not None:
+        monotonic_cst = np.concatenate(
+            (
+                monotonic_cst[booster.is_categorical_],
+                monotonic_cst[~booster.is_categorical_],
+            )
+        )
+    interaction_cst = booster._check_interaction_cst(booster._n_features)
+
+    best_rmse = None
+    if X_val is not None:
+        y_val = np.asarray(y_val, dtype=Y_DTYPE)
+        raw_val = raw_predict(booster, X_val, n_threads)
+        best_rmse = np.sqrt(np.mean((loss.link.inverse(raw_val) - y_val) ** 2))
+        best_iter = booster.n_iter_
+
+    for _ in range(n_trees):
+        if loss.constant_hessian:
+            loss.gradient(
+                y_true=y,
+                raw_prediction=raw,
+                gradient_out=gradient,
+                n_threads=n_threads,
+            )
+        else:
+            loss.gradient_hessian(
+                y_true=y,
+                raw_prediction=raw,
+                gradient_out=gradient,
+                hessian_out=hessian,
+                n_threads=n_threads,
+            )
+        grower = TreeGrower(
+            X_binned=X_binned,
+            gradients=gradient,
+            hessians=hessian,
+            n_bins=booster.max_bins + 1,
+            n_bins_non_missing=bin_mapper.n_bins_non_missing_,
+            has_missing_values=has_missing_values,
+            is_categorical=booster._is_categorical_remapped,
+            monotonic_cst=monotonic_cst,
+            interaction_cst=interaction_cst,
+            max_leaf_nodes=booster.max_leaf_nodes,
+            max_depth=booster.max_depth,
+            min_samples_leaf=booster.min_samples_leaf,
+            l2_regularization=booster.l2_regularization,
+            feature_fraction_per_split=booster.max_features,
+            rng=booster._feature_subsample_rng,
+            shrinkage=booster.learning_rate,
+            n_threads=n_threads,
+        )
+        grower.grow()
+        predictor = grower.make_predictor(binning_thresholds=bin_mapper.bin_thresholds_)
+        booster._predictors.append([predictor])
+        _update_raw_predictions(raw, grower, n_threads)
+
+        if X_val is None:
+            continue
+        raw_val += predictor.predict_binned(
+            X_val, bin_mapper.missing_values_bin_idx_, n_threads
+        )
+        rmse = np.sqrt(np.mean((loss.link.inverse(raw_val) - y_val) ** 2))
+        if rmse < best_rmse - tol:
+            best_rmse, best_iter = rmse, booster.n_iter_
+        elif booster.n_iter_ - best_iter >= n_iter_no_change:
+            break
+
+    if X_val is not None:
+        del booster._predictors[best_iter:]
+    booster.set_params(max_iter=booster.n_iter_)
+    return best_rmse
+
+
+def pipeline_key(pipeline) -> str:
+    """
+    Hash of the fitted Augmentation of the pipeline and the categories and bins
+    of its booster, which together decide the binned flights
+    :param pipeline: fitted pipeline
+    :return: hex digest
+    """
+    # The key does not depend on whether the features are precomputed
+    augmentation = copy.copy(pipeline[0]).set_params(precomputed=False)
+    booster = pipeline[-1]
+    digest = hashlib.sha256(pickle.dumps(augmentation))
+    digest.update(pickle.dumps(booster.is_categorical_))
+    for thresholds in booster._bin_mapper.bin_thresholds_:
+        digest.update(np.ascontiguousarray(thresholds).tobytes())
+    if booster._preprocessor is not None:
+        encoder = booster._preprocessor.named_transformers_["encoder"]
+        digest.update(pickle.dumps(encoder.categories_))
+    return digest.hexdigest()
+
+
+class BinnedFeatures:
+    """
+    Flights transformed by the Augmentation of a fitted pipeline and binned
+    with the bins of its booster, one uint8 per feature instead of a float64.
+    Keeps the bin edges and the categories of the categorical features, in the
+    order of the booster, and the key of the pipeline it was binned for
+    """
+
+    def __init__(self, X_binned, bin_thresholds, categories, key):
+        """
+        :param X_binned: F-contiguous uint8 matrix, as returned by bin_flights
+        :param bin_thresholds: bin edges of every feature, the categories of
+            the codes for categorical features
+        :param categories: categories of the codes of the categorical features
+        :param key: pipeline_key of the pipeline
+        """
+        self.X_binned = X_binned
+        self.bin_thresholds = bin_thresholds
+        self.categories = categories
+        self.key = key
+
+    @classmethod
+    def from_transformed(cls, pipeline, Xt):
+        """
+        Bins flights already transformed by the Augmentation of the pipeline
+        :param pipeline: fitted pipeline
+        :param Xt: transformed flights
+        :return: BinnedFeatures
+        """
+        booster = pipeline[-1]
+        categories = []
+        if booster._preprocessor is not None:
+            encoder = booster._preprocessor.named_transformers_["encoder"]
+            categories = list(encoder.categories_)
+        return cls(
+            X_binned=bin_flights(booster, Xt),
+            bin_thresholds=list(booster._bin_mapper.bin_thresholds_),
+            categories=categories,
+            key=pipeline_key(pipeline),
+        )
+
+    @classmethod
+    def from_pipeline(cls, pipeline, X):
+        """
+        Transforms and bins flights
+        :param pipeline: fitted pipeline
+        :param X: flights as taken by the pipeline
+        :return: BinnedFeatures
+        """
+        return cls.from_transformed(pipeline, pipeline[:-1].transform(X))
+
+    def __len__(self):
+        return len(self.X_binned)
+
+    def rows(self, rows):
+        """
+        :param rows: boolean mask or indices of rows
+        :return: F-contiguous uint8 matrix of the rows
+        """
+        return np.asfortranarray(self.X_binned[np.asarray(rows)])
+
+    def check(self, pipeline):
+        if pipeline_key(pipeline) != self.key:
+            raise ValueError("The flights were binned for another pipeline")
+
+    def predict(self, pipeline):
+        """
+        Predicts the binned flights with the booster of the pipeline, as its
+        predict does on the flights
+        :param pipeline: pipeline the flights were binned for
+        :return: predictions
+        """
+        self.check(pipeline)
+        booster = pipeline[-1]
+        raw = raw_predict(booster, self.X_binned, _openmp_effective_n_threads())
+        return booster._loss.link.inverse(raw)
+
+
+def cached(pipeline, path: str) -> BinnedFeatures:
+    """
+    Binned flights of a set of get_data for the pipeline, from the cache when
+    the pipeline and the inputs of get_data are unchanged
+    :param pipeline: fitted pipeline taking flights as returned by get_data
+    :param path: name of the flight list in data/
+    :return: BinnedFeatures
+    """
+    key = hashlib.sha256((pipeline_key(pipeline) + cache_key(path)).encode())
+    prefix = f"{path}-{pipeline[0].model}-binned-"
+    cache_file = f"{cache_path}{prefix}{key.hexdigest()[:16]}.pkl"
+    if os.path.exists(cache_file):
+        with open(cache_file, "rb") as f:
+            return pickle.load(f)
+
+    binned = BinnedFeatures.from_pipeline(pipeline, get_data(path))
+
+    os.makedirs(cache_path, exist_ok=True)
+    for file in os.listdir(cache_path):
+        if file.startswith(prefix) and file.endswith(".pkl"):
+            os.remove(os.path.join(cache_path, file))
+    # Replace the cache only once it is completely written
+    with open(cache_file + ".tmp", "wb") as f:
+        pickle.dump(binned, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(cache_file + ".tmp", cache_file)
+    return binned
@@ -1,7 +1,10 @@
+import functools
+import hashlib
 import os
 
 import pandas as pd
 import numpy as np
+import pyarrow.feather as feather
 
 
 p_0 = 101325  # Pa
@@ -62,94 +65,205 @@ def haversine(lat1, lon1, lat2, lon2):
 
 
 current_dir = os.path.dirname(os.path.abspath(__file__))
+cache_path = "data/cache/"
 
-masses = pd.read_csv(
-    os.path.join(current_dir, "data/masses.csv"), header=0, delimiter=","
-)
+# Bump whenever a change to get_data alters its output
+DATA_VERSION = "2"
 
-airport_data = pd.read_csv(
-    os.path.join(current_dir, "data/airport-data.csv"), header=0, delimiter=","
-)
+# Reference tables: csv file in data/ and the key each table is indexed by
+reference_tables = {
+    "masses": ("masses.csv", "aircraft_type"),
+    "airport_data": ("airport-data.csv", "airport"),
+    "flights_per_day": ("total_flights_per_day.csv", "day"),
+    "mean_performance": ("mean_data.csv", "aircraft_type"),
+}
 
-flights_per_day = pd.read_csv(
-    os.path.join(current_dir, "data/total_flights_per_day.csv"), header=0, delimiter=","
-)
+reference_files = [
+    os.path.join(current_dir, "data", file) for file, _ in reference_tables.values()
+]
 
-mean_performance = pd.read_csv(
-    os.path.join(current_dir, "data/mean_data.csv"), header=0, delimiter=","
-)
 
+@functools.lru_cache(maxsize=None)
+def reference(name: str) -> pd.DataFrame:
+    """
+    Reference table indexed by its key, read on first use and shared by all
+    later calls of the process. Tables loaded before workers are forked are
+    shared with them, the returned frame must not be modified
+    :param name: key of reference_tables
+    :return: dataframe
+    """
+    file, key = reference_tables[name]
+    return pd.read_csv(
+        os.path.join(current_dir, "data", file), header=0, delimiter=","
+    ).set_index(key)
 
-def get_data(path: str) -> pd.DataFrame:
+
+# Trajectory features of the parquet output used by the model
+trajectory_features = [
+    "avg_tas",
+    "climb_rate_mean",
+    "avg_wind_u",
+    "avg_wind_v",
+    "climb_rate_max",
+    "descent_rate_mean",
+    "descent_rate_min",
+    "max_crz_alt",
+    "mean_crz_alt",
+    "crz_tas",
+    "crz_wind_u",
+    "crz_wind_v",
+    "crz_wind_tot",
+    "crz_gnd_speed",
+    "adsb_inflight_time",
+    "landing_tas",
+    "landing_temp",
+    "dep_tas",
+    "dep_temp",
+    "init_climb_rate",
+    "time_to_10k",
+    "dep_sc",
+    "landing_sc",
+    "climb_efficiency",
+    "fuel_efficiency_proxy",
+    "climb_in_phases",
+    "cruise_in_phases",
+    "descent_in_phases",
+    "ground_in_phases",
+]
+
+# Columns looked up per flight: source table, key column of the flight list and
+# a mapping of new column to column of the source table
+feature_sources = [
+    (
+        "airport_data",
+        "adep",
+        {
+            "elevation_adep": "elevation",
+            "time_zone_adep": "timezone",
+            "lat_adep": "latitude",
+            "lon_adep": "longitude",
+        },
+    ),
+    (
+        "airport_data",
+        "ades",
+        {
+            "elevation_ades": "elevation",
+            "time_zone_ades": "timezone",
+            "lat_ades": "latitude",
+            "lon_ades": "longitude",
+        },
+    ),
+    ("masses", "aircraft_type", {"oew": "oew", "mtom": "mtom"}),
+    ("parquet_data", "flight_id", {col: col for col in trajectory_features}),
+]
+
+
+def lookup(table: pd.DataFrame, keys: pd.Series, columns: dict) -> pd.DataFrame:
+    """
+    Look up several columns of a table indexed by its key at once
+    :param table: table with a unique index
+    :param keys: key of every flight
+    :param columns: dict of new column to column of the table
+    :return: dataframe aligned with keys, NaN where the key is unknown
+    """
+    found = table[list(columns.values())].reindex(keys.to_numpy())
+    found.columns = list(columns)
+    found.index = keys.index
+    return found
+
+
+def trajectory_file(path: str) -> str:
+    # Prefer the typed parquet output of the trajectory pipeline over the csv
+    if os.path.exists(f"data/{path}_parquet.parquet"):
+        return f"data/{path}_parquet.parquet"
+    return f"data/{path}_parquet.csv"
+
+
+def cache_key(path: str) -> str:
+    """
+    Hash the content of every input of get_data together with DATA_VERSION
+    :param path: name of the flight list in data/
+    :return: hex digest
+    """
+    digest = hashlib.sha256(DATA_VERSION.encode())
+    for file in [f"data/{path}.csv", trajectory_file(path)] + reference_files:
+        with open(file, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                digest.update(chunk)
+    return digest.hexdigest()
+
+
+def get_data(path: str, use_cache: bool = True) -> pd.DataFrame:
+    """
+    Load the flight list with all features, from the feature cache when its
+    inputs and DATA_VERSION are unchanged
+    :param path: name of the flight list in data/
+    :param use_cache: read and write the cache in cache_path
+    :return: dataframe
+    """
+    if not use_cache:
+        return assemble_data(path)
+
+    key = cache_key(path)
+    cache_file = f"{cache_path}{path}-{key[:16]}.arrow"
+    if os.path.exists(cache_file):
+        # Uncompressed Arrow IPC is memory-mapped instead of parsed
+        return feather.read_table(cache_file, memory_map=True).to_pandas()
+
+    X = assemble_data(path)
+
+    os.makedirs(cache_path, exist_ok=True)
+    for file in os.listdir(cache_path):
+        if file.startswith(f"{path}-") and file.endswith(".arrow"):
+            os.remove(os.path.join(cache_path, file))
+    # Replace the cache only once it is completely written
+    feather.write_feather(X, cache_file + ".tmp", compression="uncompressed")
+    os.replace(cache_file + ".tmp", cache_file)
+    return X
+
+
+def assemble_data(path: str) -> pd.DataFrame:
     X = pd.read_csv(f"data/{path}.csv")
-    parquet_data = pd.read_csv(f"data/{path}_parquet.csv", header=0, delimiter=",")
+    if trajectory_file(path).endswith(".parquet"):
+        parquet_data = pd.read_parquet(trajectory_file(path))
+    else:
+        parquet_data = pd.read_csv(trajectory_file(path), header=0, delimiter=",")
+    return build_features(X, parquet_data)
+
+
+def build_features(X: pd.DataFrame, parquet_data: pd.DataFrame) -> pd.DataFrame:
+    """
+    Add the airport, aircraft, trajectory and physics features to a flight list
+    :param X: flights, with the columns of the challenge set
+    :param parquet_data: trajectory features of the flights
+    :return: dataframe
+    """
     # Drop duplicates by flight_id
     parquet_data = parquet_data.drop_duplicates(subset="flight_id")
 
     X["date"] = pd.to_datetime(X["date"])
     X["airport_pair"] = X["adep"] + "_" + X["ades"]
-    X["elevation_adep"] = X["adep"].map(airport_data.set_index("airport")["elevation"])
-    X["elevation_ades"] = X["ades"].map(airport_data.set_index("airport")["elevation"])
-    X["time_zone_adep"] = X["adep"].map(airport_data.set_index("airport")["timezone"])
-    X["time_zone_ades"] = X["ades"].map(airport_data.set_index("airport")["timezone"])
-    X["lat_adep"] = X["adep"].map(airport_data.set_index("airport")["latitude"])
-    X["lon_adep"] = X["adep"].map(airport_data.set_index("airport")["longitude"])
-    X["lat_ades"] = X["ades"].map(airport_data.set_index("airport")["latitude"])
-    X["lon_ades"] = X["ades"].map(airport_data.set_index("airport")["longitude"])
+
+    # Join all columns of every source table in one pass
+    tables = {
+        "airport_data": reference("airport_data"),
+        "masses": reference("masses"),
+        "parquet_data": parquet_data.set_index("flight_id"),
+    }
+    X = pd.concat(
+        [X]
+        + [
+            lookup(tables[table], X[key], columns)
+            for table, key, columns in feature_sources
+        ],
+        axis=1,
+    )
+
     X["haversine"] = haversine(
         X["lat_adep"], X["lon_adep"], X["lat_ades"], X["lon_ades"]
     )
 
-    X["oew"] = X["aircraft_type"].map(masses.set_index("aircraft_type")["oew"])
-    X["mtom"] = X["aircraft_type"].map(masses.set_index("aircraft_type")["mtom"])
-
-    X["avg_tas"] = X["flight_id"].map(parquet_data.set_index("flight_id")["avg_tas"])
-    X["climb_rate_mean"] = X["flight_id"].map(
-        parquet_data.set_index("flight_id")["climb_rate_mean"]
-    )
-    X["avg_wind_u"] = X["flight_id"].map(
-        parquet_data.set_index("flight_id")["avg_wind_u"]
-    )
-    X["avg_wind_v"] = X["flight_id"].map(
-        parquet_data.set_index("flight_id")["avg_wind_v"]
-    )
-    X["climb_rate_max"] = X["flight_id"].map(
-        parquet_data.set_index("flight_id")["climb_rate_max"]
-    )
-    X["descent_rate_mean"] = X["flight_id"].map(
-        parquet_data.set_index("flight_id")["descent_rate_mean"]
-    )
-    X["descent_rate_min"] = X["flight_id"].map(
-        parquet_data.set_index("flight_id")["descent_rate_min"]
-    )
-    X["max_crz_alt"] = X["flight_id"].map(
-        parquet_data.set_index("flight_id")["max_crz_alt"]
-    )
-    X["mean_crz_alt"] = X["flight_id"].map(
-        parquet_data.set_index("flight_id")["mean_crz_alt"]
-    )
-    X["crz_tas"] = X["flight_id"].map(parquet_data.set_index("flight_id")["crz_tas"])
-    X["crz_wind_u"] = X["flight_id"].map(
-        parquet_data.set_index("flight_id")["crz_wind_u"]
-    )
-    X["crz_wind_v"] = X["flight_id"].map(
-        parquet_data.set_index("flight_id")["crz_wind_v"]
-    )
-    X["crz_wind_tot"] = X["flight_id"].map(
-        parquet_data.set_index("flight_id")["crz_wind_tot"]
-    )
-    X["crz_gnd_speed"] = X["flight_id"].map(
-        parquet_data.set_index("flight_id")["crz_gnd_speed"]
-    )
-    X["adsb_inflight_time"] = X["flight_id"].map(
-        parquet_data.set_index("flight_id")["adsb_inflight_time"]
-    )
-    X["landing_tas"] = X["flight_id"].map(
-        parquet_data.set_index("flight_id")["landing_tas"]
-    )
-    X["landing_temp"] = X["flight_id"].map(
-        parquet_data.set_index("flight_id")["landing_temp"]
-    )
     X["landing_pressure"] = X["elevation_ades"].apply(pressure)
     X["landing_density"] = (
         0.0289652  # kg/mol
@@ -161,8 +275,6 @@ def get_data(path: str) -> pd.DataFrame:
     X["landing_cas_squared"] = X["landing_tas"] ** 2
     X["landing_mass"] = X["landing_density"] * X["landing_cas_squared"]
 
-    X["dep_tas"] = X["flight_id"].map(parquet_data.set_index("flight_id")["dep_tas"])
-    X["dep_temp"] = X["flight_id"].map(parquet_data.set_index("flight_id")["dep_temp"])
     X["dep_pressure"] = X["elevation_adep"].apply(pressure)
     X["dep_density"] = (
         0.0289652 * X["dep_pressure"] / X["dep_temp"] / 8.31446  # kg/mol  # Nm/(mol K)
@@ -171,52 +283,51 @@ def get_data(path: str) -> pd.DataFrame:
     X["dep_cas_squared"] = X["dep_tas"] ** 2
     X["dep_mass"] = X["dep_density"] * X["dep_cas_squared"]
 
-    X["init_climb_rate"] = X["flight_id"].map(
-        parquet_data.set_index("flight_id")["init_climb_rate"]
-    )
-    X["time_to_10k"] = X["flight_id"].map(
-        parquet_data.set_index("flight_id")["time_to_10k"]
-    )
-    X["dep_sc"] = X["flight_id"].map(parquet_data.set_index("flight_id")["dep_sc"])
-    X["landing_sc"] = X["flight_id"].map(
-        parquet_data.set_index("flight_id")["landing_sc"]
-    )
-    X["climb_efficiency"] = X["flight_id"].map(
-        parquet_data.set_index("flight_id")["climb_efficiency"]
-    )
-    X["fuel_efficiency_proxy"] = X["flight_id"].map(
-        parquet_data.set_index("flight_id")["fuel_efficiency_proxy"]
-    )
-    X["climb_in_phases"] = X["flight_id"].map(
-        parquet_data.set_index("flight_id")["climb_in_phases"]
-    )
-    X["cruise_in_phases"] = X["flight_id"].map(
-        parquet_data.set_index("flight_id")["cruise_in_phases"]
-    )
-    X["descent_in_phases"] = X["flight_id"].map(
-        parquet_data.set_index("flight_id")["descent_in_phases"]
-    )
-    X["ground_in_phases"] = X["flight_id"].map(
-        parquet_data.set_index("flight_id")["ground_in_phases"]
-    )
-
     X["flights_per_day"] = X["date"].dt.date.map(
-        flights_per_day.set_index("day")["flights"]
+        reference("flights_per_day")["flights"]
     )
 
     # Use the mean values for the aircraft type to scale the data
-    new_columns = {}
-    for col in list(mean_performance):
-        if col == "aircraft_type":
-            continue
-        # Map and scale values as before
-        acft_col = X["aircraft_type"].map(
-            mean_performance.set_index("aircraft_type")[col]
-        )
-        new_columns[f"acft-{col}"] = acft_col
-        new_columns[f"scaled-{col}"] = X[col] / acft_col
+    columns = list(reference("mean_performance"))
+    acft = lookup(
+        reference("mean_performance"),
+        X["aircraft_type"],
+        {f"acft-{col}": col for col in columns},
+    )
+    scaled = X[columns] / acft.to_numpy()
+    scaled.columns = [f"scaled-{col}" for col in columns]
 
     # Add all new columns to X at once to avoid fragmentation
-    X = pd.concat([X, pd.DataFrame(new_columns)], axis=1)
+    X = pd.concat([X, acft, scaled], axis=1)
 
-    return X
+    # Keep the column order of the original column by column assembly
+    physics = {
+        "landing_temp": [
+            "landing_pressure",
+            "landing_density",
+            "landing_cas",
+            "landing_cas_squared",
+            "landing_mass",
+        ],
+        "dep_temp": [
+            "dep_pressure",
+            "dep_density",
+            "dep_cas",
+            "dep_cas_squared",
+            "dep_mass",
+        ],
+    }
+    added = (
+        ["airport_pair"]
+        + [
+            f"{col}_{airport}"
+            for col in ["elevation", "time_zone"]
+            for airport in ["adep", "ades"]
+        ]
+        + [f"{col}_{airport}" for airport in ["adep", "ades"] for col in ["lat", "lon"]]
+        + ["haversine", "oew", "mtom"]
+        + [name for col in trajectory_features for name in [col] + physics.get(col, [])]
+        + ["flights_per_day"]
+        + [name for col in columns for name in [f"acft-{col}", f"scaled-{col}"]]
+    )
+    return X[[col for col in X.columns if col not in added] + added]
@@ -10,7 +10,25 @@ def combine_all_csv_from_path(path: str):
     return df
 
 
+def combine_all_parquet_from_path(path: str, output: str):
+    import os
+
+    import pyarrow.parquet as pq
+
+    all_files = sorted(f for f in os.listdir(path) if f.endswith(".parquet"))
+    schema = pq.read_schema(os.path.join(path, all_files[0]))
+    # Stream the daily files into the output, one row group per day
+    with pq.ParquetWriter(output, schema) as writer:
+        for f in all_files:
+            writer.write_table(pq.read_table(os.path.join(path, f), schema=schema))
+
+
 if __name__ == "__main__":
+    import os
+
     path = "challenge_set"
-    df = combine_all_csv_from_path(path)
-    df.to_csv(f"{path}_parquet.csv", index=False)
+    if any(f.endswith(".parquet") for f in os.listdir(path)):
+        combine_all_parquet_from_path(path, f"{path}_parquet.parquet")
+    else:
+        df = combine_all_csv_from_path(path)
+        df.to_csv(f"{path}_parquet.csv", index=False)
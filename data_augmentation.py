@@ -1,11 +1,79 @@
 from sklearn.base import BaseEstimator, TransformerMixin
-from sklearn.preprocessing import OneHotEncoder, StandardScaler, OrdinalEncoder
+from sklearn.preprocessing import StandardScaler, OrdinalEncoder
 import pandas as pd
 import numpy as np
 
 from dates.tabular import create_time_features_tabular
 
 
+def to_local_time(times: pd.Series, time_zones: pd.Series) -> pd.Series:
+    """
+    Convert UTC times to naive local times, one vectorized conversion per zone
+    :param times: timezone-aware times
+    :param time_zones: IANA time zone of every row
+    :return: series of naive local times, NaT where the zone is missing
+    """
+    local = np.full(len(times), np.datetime64("NaT"), dtype="datetime64[ns]")
+    groups = times.groupby(time_zones.to_numpy(), sort=False).indices
+    for time_zone, rows in groups.items():
+        local[rows] = times.iloc[rows].dt.tz_convert(time_zone).dt.tz_localize(None)
+    return pd.Series(local, index=times.index)
+
+
+class FrequencyBucketer(BaseEstimator, TransformerMixin):
+    """
+    Groups the categories seen less than min_frequency times during fit into a
+    single infrequent category. Gives the same values as the round trip through
+    a OneHotEncoder with handle_unknown="infrequent_if_exist", without building
+    the one-hot matrix
+    """
+
+    def __init__(self, min_frequency, infrequent="infrequent_sklearn"):
+        self.min_frequency = min_frequency
+        self.infrequent = infrequent
+
+    def fit(self, X, y=None):
+        counts = pd.Series(X).value_counts(dropna=False)
+        self.frequent_ = counts.index[counts >= self.min_frequency]
+        self.has_infrequent_ = bool((counts < self.min_frequency).any())
+        # The same categories for every transform, whichever ones the flights have
+        categories = list(self.frequent_.dropna())
+        if self.has_infrequent_:
+            categories.append(self.infrequent)
+        self.dtype_ = pd.CategoricalDtype(categories)
+        return self
+
+    def transform(self, X, y=None):
+        X = pd.Series(X)
+        # Unknown categories are infrequent, or missing without infrequent ones
+        other = self.infrequent if self.has_infrequent_ else None
+        return pd.Categorical(X.where(X.isin(self.frequent_), other), dtype=self.dtype_)
+
+
+class MatrixBuckets(BaseEstimator, TransformerMixin):
+    """
+    Airport bucketing of Augmentation.encode on the codes of the matrix built
+    by Augmentation.to_matrix
+    """
+
+    def __init__(self, columns):
+        # Column index to minimum frequency and code of the infrequent category
+        self.columns = columns
+
+    def fit(self, X, y=None):
+        self.encoders_ = {
+            col: FrequencyBucketer(min_frequency, infrequent).fit(X[:, col])
+            for col, (min_frequency, infrequent) in self.columns.items()
+        }
+        return self
+
+    def transform(self, X, y=None):
+        X = np.array(X)
+        for col, encoder in self.encoders_.items():
+            X[:, col] = np.asarray(encoder.transform(X[:, col]), dtype=X.dtype)
+        return X
+
+
 class Augmentation(BaseEstimator, TransformerMixin):
     def __init__(
         self,
@@ -14,81 +82,136 @@ class Augmentation(BaseEstimator, TransformerMixin):
         num_features,
         cat_features=None,
         ordinal_features=None,
+        precomputed=False,
     ):
         self.one_hot_features = one_hot_features
         self.num_features = num_features
         self.ordinal_features = ordinal_features
         self.cat_features = cat_features
         self.model = model
-        self.adep_encoder = OneHotEncoder(
-            min_frequency=50,
-            handle_unknown="infrequent_if_exist",
-            sparse_output=False,
-        )
-        self.ades_encoder = OneHotEncoder(
-            min_frequency=50,
-            handle_unknown="infrequent_if_exist",
-            sparse_output=False,
-        )
-        self.pair_encoder = OneHotEncoder(
-            min_frequency=450,
-            handle_unknown="infrequent_if_exist",
-            sparse_output=False,
-        )
+        self.precomputed = precomputed
+        self.adep_encoder = FrequencyBucketer(min_frequency=50)
+        self.ades_encoder = FrequencyBucketer(min_frequency=50)
+        self.pair_encoder = FrequencyBucketer(min_frequency=450)
 
     def fit(self, X, y=None):
-        self.adep_encoder.fit(X[["adep"]])
-        self.ades_encoder.fit(X[["ades"]])
-        self.pair_encoder.fit(X[["airport_pair"]])
+        self.adep_encoder.fit(X["adep"])
+        self.ades_encoder.fit(X["ades"])
+        self.pair_encoder.fit(X["airport_pair"])
         return self
 
     def transform(self, X, y=None):
-        X["date_col"] = pd.to_datetime(X["actual_offblock_time"])
-        date_col = X.apply(
-            lambda x: x["date_col"].tz_convert(x["time_zone_adep"]).tz_localize(None),
-            axis=1,
-        )
-        date_col = pd.to_datetime(date_col)
+        if not self.precomputed:
+            X = self.features(X)
+        return self.encode(X)
 
-        df = create_time_features_tabular(date_col)
+    def features(self, X):
+        """
+        Computes the features that do not depend on the fitted encoders, with
+        the raw airports for all models
+        :param X: flights as returned by get_data
+        :return: dataframe
+        """
+        # Both times are in the local time of the departure airport
+        date_col = to_local_time(
+            pd.to_datetime(X["actual_offblock_time"]), X["time_zone_adep"]
+        )
+        df = create_time_features_tabular(date_col, countries=X["country_code_adep"])
 
-        X["date_col"] = pd.to_datetime(X["arrival_time"])
-        date_col = X.apply(
-            lambda x: x["date_col"].tz_convert(x["time_zone_adep"]).tz_localize(None),
-            axis=1,
+        arrival_time = pd.to_datetime(X["arrival_time"])
+        date_col = to_local_time(arrival_time, X["time_zone_adep"])
+        # Holidays of the arrival country are checked in its own local time
+        df2 = create_time_features_tabular(
+            date_col,
+            "_arr",
+            countries=X["country_code_ades"],
+            holiday_col=to_local_time(arrival_time, X["time_zone_ades"]),
         )
-        date_col = pd.to_datetime(date_col)
-        df2 = create_time_features_tabular(date_col, "_arr")
         df = pd.concat([df, df2], axis=1)
 
         df["mtom"] = X["mtom"]
         df["oew"] = X["oew"]
+        df["adep"] = X["adep"]
+        df["ades"] = X["ades"]
+        df["airport_pair"] = X["airport_pair"]
+
+        columns = {col: X[col].astype("category") for col in self.cat_features}
+        columns.update({col: X[col] for col in self.num_features})
+        for col in [col for col in columns if col in df]:
+            df[col] = columns.pop(col)
+        # Add all other columns at once to avoid fragmentation
+        return pd.concat([df, pd.DataFrame(columns, index=df.index)], axis=1)
+
+    def to_matrix(self, df, path):
+        """
+        Stores the output of features as a float64 matrix memory-mapped from
+        path, which worker processes share instead of receiving a copy.
+        Categorical columns hold codes in sorted category order, the order
+        HistGradientBoostingRegressor gives to the categories of encode
+        :param df: output of features
+        :param path: .npy file
+        :return: matrix, mask of the categorical columns and the airport
+            bucketing to fit for every fold in place of encode
+        """
+        airports = {
+            "adep": self.adep_encoder,
+            "ades": self.ades_encoder,
+            "airport_pair": self.pair_encoder,
+        }
+        matrix = np.lib.format.open_memmap(
+            path, mode="w+", dtype=np.float64, shape=df.shape
+        )
+        categorical = np.zeros(df.shape[1], dtype=bool)
+        buckets = {}
+        for i, col in enumerate(df.columns):
+            values = df[col]
+            if col in airports and self.model == "shap":
+                values = pd.Series(np.zeros(len(df)), index=df.index)
+            if col not in airports and values.dtype != "category":
+                matrix[:, i] = values.to_numpy(dtype=np.float64, na_value=np.nan)
+                continue
+            categories = set(values.dropna().unique())
+            if col in airports and self.model == "tabular":
+                encoder = airports[col]
+                categories.add(encoder.infrequent)
+                categories = sorted(categories)
+                buckets[i] = (
+                    encoder.min_frequency,
+                    categories.index(encoder.infrequent),
+                )
+            else:
+                categories = sorted(categories)
+            codes = pd.Categorical(values, categories=categories).codes
+            matrix[:, i] = np.where(codes >= 0, codes, np.nan)
+            categorical[i] = True
+        matrix.flush()
+        del matrix
+        return np.load(path, mmap_mode="r"), categorical, MatrixBuckets(buckets)
+
+    def encode(self, df):
+        """
+        Buckets the airports of the output of features with the fitted encoders,
+        or replaces them with zeros for the shap model
+        :param df: output of features, left unchanged
+        :return: dataframe
+        """
+        df = df.copy(deep=False)
         if self.model == "tabular":
-            df["adep"] = self.adep_encoder.inverse_transform(
-                self.adep_encoder.transform(X[["adep"]])
-            ).reshape(-1)
-            df["ades"] = self.ades_encoder.inverse_transform(
-                self.ades_encoder.transform(X[["ades"]])
-            ).reshape(-1)
-            df["airport_pair"] = self.pair_encoder.inverse_transform(
-                self.pair_encoder.transform(X[["airport_pair"]])
-            ).reshape(-1)
+            df["adep"] = self.adep_encoder.transform(df["adep"])
+            df["ades"] = self.ades_encoder.transform(df["ades"])
+            df["airport_pair"] = self.pair_encoder.transform(df["airport_pair"])
         elif self.model == "shap":
-            df["adep"] = np.zeros(X.shape[0])
-            df["ades"] = np.zeros(X.shape[0])
-            df["airport_pair"] = np.zeros(X.shape[0])
+            df["adep"] = np.zeros(df.shape[0])
+            df["ades"] = np.zeros(df.shape[0])
+            df["airport_pair"] = np.zeros(df.shape[0])
 
         df["adep"] = df["adep"].astype("category")
         df["ades"] = df["ades"].astype("category")
         df["airport_pair"] = df["airport_pair"].astype("category")
-        for col in self.cat_features:
-            df[col] = X[col].astype("category")
-        for col in self.num_features:
-            df[col] = X[col]
         return df
 
 
-def get_constructor(model: str):
+def get_constructor(model: str, precomputed=False):
     # what about in phases?
     parquet_features = [
         "avg_tas",
@@ -183,5 +306,6 @@ def get_constructor(model: str):
         one_hot_features=None,
         cat_features=cat_columns,
         num_features=num_columnns + parquet_features,
+        precomputed=precomputed,
     )
     return constructor
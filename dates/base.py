@@ -1,17 +1,77 @@
-from datetime import datetime
+from datetime import datetime, timedelta
 
+import pandas as pd
+
+# Holidays on the same day of every year, as (month, day)
 holidays = [
-    datetime(2022, 12, 25),
-    datetime(2022, 1, 1),
+    (12, 25),
+    (1, 1),
 ]
 
+# Additional holidays per country code, on top of the ones above, as a set of
+# dates of every year, so that movable holidays are covered, e.g.
+# {"DE": {"2023-04-07", "2023-04-10", "2023-10-03"}}
+country_holidays = {}
+
+
+def iata_summer_season(year: int):
+    """
+    IATA summer schedule of a year, from the last Sunday in March up to the
+    last Saturday in October
+    :param year:
+    :return: start and end datetime, the end is excluded
+    """
+    march_end = datetime(year, 3, 31)
+    october_end = datetime(year, 10, 31)
+    start = march_end - timedelta(days=(march_end.weekday() - 6) % 7)
+    end = october_end - timedelta(days=(october_end.weekday() - 5) % 7)
+    return start, end
+
 
 def iata_schedule_flag(date):
-    # Define IATA schedule start and end dates for 2022
-    iata_summer_start = datetime(2022, 3, 27)  # Last Sunday in March
-    iata_summer_end = datetime(2022, 10, 29)  # Last Saturday in October
+    iata_summer_start, iata_summer_end = iata_summer_season(date.year)
     # Check if date is within the summer schedule
     if iata_summer_start <= date.replace(tzinfo=None) < iata_summer_end:
         return 0
     else:
         return 1
+
+
+def iata_schedule_flags(date_col: pd.Series) -> pd.Series:
+    """
+    Vectorized iata_schedule_flag, comparing every date with the season
+    boundaries of its year
+    :param date_col: naive datetimes
+    :return: series of 0 in the summer schedule and 1 in the winter schedule
+    """
+    years = date_col.dt.year
+    seasons = {year: iata_summer_season(int(year)) for year in years.dropna().unique()}
+    start = years.map({year: season[0] for year, season in seasons.items()})
+    end = years.map({year: season[1] for year, season in seasons.items()})
+    return (~((date_col >= start) & (date_col < end))).astype(int)
+
+
+def holiday_flags(date_col: pd.Series, countries: pd.Series = None) -> pd.Series:
+    """
+    Flag the dates that are holidays
+    :param date_col: naive datetimes
+    :param countries: country code of every date, to also use country_holidays
+    :return: series of 1 on holidays and 0 otherwise
+    """
+    days = date_col.dt.normalize()
+    years = days.dt.year.dropna().unique()
+    is_holiday = days.isin(
+        pd.DatetimeIndex(
+            [
+                datetime(int(year), month, day)
+                for year in years
+                for month, day in holidays
+            ]
+        )
+    )
+    if countries is not None:
+        for country, calendar in country_holidays.items():
+            is_holiday |= (countries == country) & days.isin(
+                pd.DatetimeIndex(sorted(calendar))
+            )
+    return is_holiday.astype(int)
@@ -1,9 +1,18 @@
 import pandas as pd
 
-from dates.base import iata_schedule_flag, holidays
+from dates.base import holiday_flags, iata_schedule_flags
 
 
-def create_time_features_tabular(date_col, arr=""):
+def create_time_features_tabular(date_col, arr="", countries=None, holiday_col=None):
+    """
+    Calendar features of local times
+    :param date_col: naive local times
+    :param arr: suffix of the column names
+    :param countries: country code of every time, for the country holidays
+    :param holiday_col: naive times in the local time of countries, for the
+        holidays, date_col if None
+    :return: dataframe
+    """
     df = pd.DataFrame(
         {
             f"month{arr}": date_col.dt.month,
@@ -16,10 +25,10 @@ def create_time_features_tabular(date_col, arr=""):
             f"is_month_end{arr}": date_col.dt.is_month_end.astype(int),
             f"is_weekend{arr}": (date_col.dt.dayofweek >= 5).astype(int),
             f"quarter{arr}": date_col.dt.quarter,
-            f"iata_schedule_flag{arr}": date_col.apply(iata_schedule_flag),
+            f"iata_schedule_flag{arr}": iata_schedule_flags(date_col),
         }
     )
-    df[f"is_holiday{arr}"] = date_col.apply(
-        lambda x: int(x.date() in [h.date() for h in holidays])
-    )
+    if holiday_col is None:
+        holiday_col = date_col
+    df[f"is_holiday{arr}"] = holiday_flags(holiday_col, countries)
     return df
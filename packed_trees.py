@@ -0,0 +1,265 @@
+import os
+import pickle
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from binned_features import bin_flights, cached
+from create_Xy import get_data
+
+pipeline_path = "pipeline.pkl"
+packed_path = "pipeline_packed.npz"
+chunk_size = 1024  # rows a thread routes through the trees at a time
+block_size = 64  # trees routed together
+n_threads = os.cpu_count()
+
+
+def bin_features(pipeline, X):
+    """
+    Bins flights with the bins of the booster at the end of the pipeline
+    :param pipeline: fitted pipeline
+    :param X: flights as returned by get_data
+    :return: uint8 matrix, one row per flight
+    """
+    return np.ascontiguousarray(bin_flights(pipeline[-1], pipeline[:-1].transform(X)))
+
+
+class PackedTrees:
+    """
+    The trees of a fitted HistGradientBoostingRegressor in contiguous node
+    arrays, evaluated on binned features.
+
+    Nodes keep the depth-first order of the predictors, so the left child of
+    a node is the next node. Every node points to a row of the decision table,
+    which tells for each bin whether the node sends it right. Row 0 sends every
+    bin right and belongs to the leaves, which are their own right child, so
+    that a row stays on its leaf once it is reached
+    """
+
+    def __init__(self, feature, decision, right, value, roots, depth, table, baseline):
+        """
+        :param feature: feature of the split of every node
+        :param decision: row of the decision table of every node
+        :param right: right child of every node
+        :param value: value of every node, used at the leaves
+        :param roots: root node of every tree
+        :param depth: maximum depth of every tree
+        :param table: decision table, 256 bits per row
+        :param baseline: baseline prediction of the booster
+        """
+        self.feature = feature
+        self.decision = decision
+        self.right = right
+        self.value = value
+        self.roots = roots
+        self.depth = depth
+        self.table = table
+        self.baseline = baseline
+        # Working copies indexed by the traversal
+        self.split_feature = feature.astype(np.intp)
+        self.split_row = decision.astype(np.intp) * 256
+        self.skip = right.astype(np.intp) - np.arange(len(right)) - 1
+        self.goes_right = np.unpackbits(table, axis=1, bitorder="little").ravel()
+        self.is_leaf = decision == 0
+
+    @classmethod
+    def from_booster(cls, booster):
+        """
+        Packs the trees of a fitted HistGradientBoostingRegressor
+        :param booster:
+        :return: PackedTrees
+        """
+        missing = booster._bin_mapper.missing_values_bin_idx_
+        bins = np.arange(256)
+        # Numeric splits only depend on the bin threshold and the side of the
+        # missing values, categorical splits get a row per distinct bitset
+        rows = [np.ones(256, dtype=bool)]
+        for missing_left in [False, True]:
+            for threshold in range(256):
+                row = bins > threshold
+                row[missing] = not missing_left
+                rows.append(row)
+        categorical_rows = {}
+
+        arrays = {name: [] for name in ["feature", "decision", "right", "value"]}
+        roots = []
+        depth = []
+        offset = 0
+        for (predictor,) in booster._predictors:
+            nodes = predictor.nodes
+            n = len(nodes)
+            is_leaf = nodes["is_leaf"].astype(bool)
+            internal = np.flatnonzero(~is_leaf)
+            if np.any(nodes["left"][internal] != internal + 1):
+                raise ValueError("Nodes of the predictor are not in depth-first order")
+
+            decision = np.where(
+                is_leaf,
+                0,
+                1 + nodes["bin_threshold"] + 256 * nodes["missing_go_to_left"],
+            ).astype(np.int64)
+            categorical = np.flatnonzero(nodes["is_categorical"] & ~is_leaf)
+            if len(categorical):
+                bitsets = np.ascontiguousarray(
+                    predictor.binned_left_cat_bitsets, dtype="<u4"
+                )
+                left = np.unpackbits(
+                    bitsets.view(np.uint8), axis=1, bitorder="little"
+                ).astype(bool)
+                for node in categorical:
+                    row = ~left[nodes["bitset_idx"][node]]
+                    row[missing] = not nodes["missing_go_to_left"][node]
+                    key = row.tobytes()
+                    if key not in categorical_rows:
+                        categorical_rows[key] = len(rows)
+                        rows.append(row)
+                    decision[node] = categorical_rows[key]
+
+            arrays["feature"].append(nodes["feature_idx"])
+            arrays["decision"].append(decision)
+            arrays["right"].append(
+                np.where(is_leaf, np.arange(n), nodes["right"]) + offset
+            )
+            arrays["value"].append(nodes["value"])
+            roots.append(offset)
+            depth.append(nodes["depth"].max())
+            offset += n
+
+        n_features = booster._bin_mapper.n_bins_non_missing_.shape[0]
+        return cls(
+            feature=np.concatenate(arrays["feature"]).astype(
+                np.min_scalar_type(n_features)
+            ),
+            decision=np.concatenate(arrays["decision"]).astype(np.int32),
+            right=np.concatenate(arrays["right"]).astype(np.int32),
+            value=np.concatenate(arrays["value"]).astype(np.float64),
+            roots=np.array(roots, dtype=np.int64),
+            depth=np.array(depth, dtype=np.int32),
+            table=np.packbits(np.array(rows), axis=1, bitorder="little"),
+            baseline=np.float64(booster._baseline_prediction[0, 0]),
+        )
+
+    def save(self, path):
+        """
+        Writes the node arrays to an uncompressed .npz file
+        :param path:
+        """
+        np.savez(
+            path,
+            feature=self.feature,
+            decision=self.decision,
+            right=self.right,
+            value=self.value,
+            roots=self.roots,
+            depth=self.depth,
+            table=self.table,
+            baseline=self.baseline,
+        )
+
+    @classmethod
+    def load(cls, path):
+        """
+        Reads node arrays written by save
+        :param path:
+        :return: PackedTrees
+        """
+        with np.load(path) as arrays:
+            return cls(**{name: arrays[name] for name in arrays.files})
+
+    def predict(self, X, n_threads=n_threads):
+        """
+        Predicts binned rows in chunks on a pool of threads, numpy releases the
+        GIL while indexing so the chunks run in parallel
+        :param X: uint8 matrix as returned by bin_features
+        :param n_threads: number of threads
+        :return: predictions, equal to those of the booster
+        """
+        X = np.ascontiguousarray(X, dtype=np.uint8)
+        if not len(X):
+            return np.empty(0)
+        chunks = [
+            X[start : start + chunk_size] for start in range(0, len(X), chunk_size)
+        ]
+        with ThreadPoolExecutor(n_threads) as executor:
+            return np.concatenate(list(executor.map(self.predict_chunk, chunks)))
+
+    def predict_chunk(self, X):
+        """
+        Routes a chunk of rows through blocks of trees at once, one level per
+        step, and drops the rows that reached their leaf every other step
+        :param X: C-contiguous uint8 matrix
+        :return: predictions
+        """
+        rows, n_features = X.shape
+        x = X.ravel()
+        out = np.full(rows, self.baseline)
+        offsets = np.arange(rows) * n_features
+        for start in range(0, len(self.roots), block_size):
+            roots = self.roots[start : start + block_size]
+            node = np.repeat(roots.astype(np.intp), rows)
+            offset = np.tile(offsets, len(roots))
+            leaf = node.copy()
+            position = np.arange(len(node))
+            for level in range(self.depth[start : start + block_size].max()):
+                index = self.split_feature[node]
+                index += offset
+                row = self.split_row[node]
+                row += x[index]
+                # Left child is the next node, the right one is skip nodes further
+                step = self.skip[node]
+                step *= self.goes_right[row]
+                step += 1
+                node += step
+                # Few rows reach a leaf in the first levels
+                if level >= 6 and level % 2 == 0:
+                    leaf[position] = node
+                    active = np.flatnonzero(~self.is_leaf[node])
+                    node = node[active]
+                    offset = offset[active]
+                    position = position[active]
+            leaf[position] = node
+            # Add the trees in order, as the booster does
+            for value in self.value[leaf].reshape(len(roots), rows):
+                out += value
+        return out
+
+
+if __name__ == "__main__":
+    start = time.perf_counter()
+    with open(pipeline_path, "rb") as f:
+        pipeline = pickle.load(f)
+    print(f"Loaded {pipeline_path} in {time.perf_counter() - start:.2f}s")
+    packed = PackedTrees.from_booster(pipeline[-1])
+    packed.save(packed_path)
+    start = time.perf_counter()
+    packed = PackedTrees.load(packed_path)
+    print(f"Loaded {packed_path} in {time.perf_counter() - start:.2f}s")
+
+    X = get_data("final_submission_set")
+    start = time.perf_counter()
+    expected = pipeline.predict(X)
+    seconds = time.perf_counter() - start
+    print(
+        f"pipeline.predict: {len(X) / seconds:.0f} flights/s, "
+        f"{pipeline[-1].n_iter_} trees"
+    )
+
+    start = time.perf_counter()
+    X_binned = bin_features(pipeline, X)
+    binning = time.perf_counter() - start
+    cached(pipeline, "final_submission_set")
+    start = time.perf_counter()
+    cached(pipeline, "final_submission_set")
+    print(
+        f"Binned flights read from the cache in {time.perf_counter() - start:.2f}s, "
+        f"transforming and binning takes {binning:.2f}s"
+    )
+    start = time.perf_counter()
+    tow = packed.predict(X_binned)
+    seconds = time.perf_counter() - start
+    print(
+        f"PackedTrees.predict: {len(X) / seconds:.0f} flights/s on binned flights, "
+        f"{len(X) / (seconds + binning):.0f} flights/s including the binning"
+    )
+    print(f"Largest difference to pipeline.predict: {np.abs(tow - expected).max()}")
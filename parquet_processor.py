@@ -1,14 +1,28 @@
 import os
-from concurrent.futures import as_completed, ProcessPoolExecutor
+from concurrent.futures import ProcessPoolExecutor
 
 import pandas as pd
 from datetime import datetime
 
-from traffic.core import Traffic, Flight
+from traffic.core import Flight
+
+from trajectory.features import (
+    FEATURE_COLUMNS,
+    FEATURE_VERSION,
+    PHASE_FLAGS,
+    compute_features,
+    flight_kernel,
+    prepare_flight,
+)
+from trajectory.io import TRAJECTORY_COLUMNS, read_trajectories, write_features
+from trajectory.manifest import Manifest
+from trajectory.scheduling import estimate_memory, submit_bounded
 
 target_set = "data/challenge_set.csv"
 output_path = "data/challenge_set/"
 parquet_path = "data/parquet/"
+memory_budget = 16 * 2**30  # bytes available to all workers together
+phase_method = "traffic"  # or "fast" for the vectorized phase labeller
 
 
 def load_flights(date: datetime.date):
@@ -22,191 +36,176 @@ def load_flights(date: datetime.date):
     return df
 
 
+def partition_flights():
+    """
+    Load the flight(-ids) of the given set once and bucket them by offblock date
+    :return: dict of date string to dataframe
+    """
+    df = pd.read_csv(target_set, usecols=["flight_id", "actual_offblock_time"])
+    return {
+        date_str: flights
+        for date_str, flights in df.groupby(df["actual_offblock_time"].str[:10])
+    }
+
+
 def process_one_flight(flight: Flight):
     """
     Processes a single flight
     :param flight:
     :return:
     """
-    flight_id = flight.flight_id
-    df = flight.data.copy()
-    df.rename(
-        columns={
-            "u_component_of_wind": "wind_u",
-            "v_component_of_wind": "wind_v",
-        },
-        inplace=True,
+    flt, unique_phases = prepare_flight(flight)
+
+    features = flight_kernel(flt.data.assign(flight_id=flight.flight_id))
+    result = {name: values[0] for name, values in features.items()}
+    result["flight_id"] = int(result["flight_id"])
+    result.update(
+        {flag: int(phase in unique_phases) for flag, phase in PHASE_FLAGS.items()}
     )
-    df.drop_duplicates(inplace=True)
-    df.sort_values(by="timestamp", inplace=True)
-
-    # Create a Flight object from the cleaned dataframe
-    flt = Flight(df)
-
-    # Rename columns using pandas rename function
-    try:
-        flt = flt.compute_TAS()
-    except Exception as e:
-        print("Error computing TAS for flight " + str(flight_id), e)
-
-    # Compute the phases of the flight
-    flt = flt.phases()
-    unique_phases = flt.data["phase"].unique()
-
-    # Remove NA and GROUND phases
-    flt.data = flt.data[flt.data["phase"] != "NA"]
-    flt.data = flt.data[flt.data["phase"] != "GROUND"]
-
-    # Resample the data to 10s intervals
-    flt = flt.resample("10s")
-
-    # Compute the time to climb 10,000 feet
-    altitude_gain = (flt.data["vertical_rate"] / 6).cumsum()
-    reached_10k = altitude_gain >= 10000
-    if reached_10k.any():
-        time_to_10k = (
-            flt.data[reached_10k]["timestamp"].iloc[0] - flt.data["timestamp"].iloc[0]
-        ).total_seconds() / 60  # time in minutes
-    else:
-        # If the flight didn't climb 10,000 feet, handle accordingly
-        time_to_10k = pd.NA
-
-    # Filter the data based on the phases
-    flt_phase_climb = flt.data["phase"] == "CLIMB"
-    flt_phase_descent = flt.data["phase"] == "DESCENT"
-    flt_phase_cruise = flt.data["phase"] == "CRUISE"
-
-    result = {
-        "flight_id": int(flt.flight_id),
-        "avg_tas": flt.data["TAS"].mean(),
-        "avg_wind_u": flt.data["wind_u"].mean(),
-        "avg_wind_v": flt.data["wind_v"].mean(),
-        "climb_rate_mean": flt.data[flt_phase_climb]["vertical_rate"].mean(),
-        "climb_rate_max": flt.data[flt_phase_climb]["vertical_rate"].max(),
-        "descent_rate_mean": flt.data[flt_phase_descent]["vertical_rate"].mean(),
-        "descent_rate_min": flt.data[flt_phase_descent]["vertical_rate"].min(),
-        "max_crz_alt": flt.data["altitude"].max() / 100,
-        "adsb_inflight_time": (
-            flt.data["timestamp"].max() - flt.data["timestamp"].min()
-        ).total_seconds()
-        / 3600,
-        "landing_tas": flt.data["TAS"].iloc[-1],
-        "landing_temp": flt.data["temperature"].iloc[-1],
-        "dep_temp": flt.data["temperature"].iloc[0],
-        "dep_tas": flt.data["TAS"].iloc[flt.data["TAS"].first_valid_index()],
-        "init_climb_rate": flt.data["vertical_rate"]
-        .iloc[
-            flt.data["vertical_rate"]
-            .first_valid_index() : flt.data["vertical_rate"]
-            .first_valid_index()
-            + 3
-        ]
-        .mean(),
-        "time_to_10k": time_to_10k,
-        "dep_sc": flt.data["specific_humidity"].iloc[0],
-        "landing_sc": flt.data["specific_humidity"].iloc[-1],
-        "climb_efficiency": flt.data[flt.data["phase"] == "CLIMB"][
-            "vertical_rate"
-        ].mean()
-        / flt.data[flt.data["phase"] == "CLIMB"]["groundspeed"].mean(),
-        "climb_in_phases": int("CLIMB" in unique_phases),
-        "cruise_in_phases": int("CRUISE" in unique_phases),
-        "descent_in_phases": int("DESCENT" in unique_phases),
-        "ground_in_phases": int("GROUND" in unique_phases),
-    }
+    return {column: result[column] for column in FEATURE_COLUMNS}
+
 
-    # Iff we have a cruise phase, compute the cruise metrics
-
-    cruise_part = flt.data[flt_phase_cruise]
-
-    if cruise_part.empty:
-        cruise_part = flt.data[flt.data["phase"] == "LEVEL"]
-
-    if cruise_part.empty:
-        print("No cruise or level phase found for flight " + str(flight_id))
-    else:
-        cruise_res = {
-            "mean_crz_alt": cruise_part["altitude"].mean() / 100,
-            "descent_rate_min": flt.data[flt.data["phase"] == "DESCENT"][
-                "vertical_rate"
-            ].min(),
-            "crz_tas": cruise_part["TAS"].mean(),
-            "crz_wind_u": cruise_part["wind_u"].mean(),
-            "crz_wind_v": cruise_part["wind_v"].mean(),
-            "crz_wind_tot": (
-                cruise_part["wind_u"] ** 2 + cruise_part["wind_v"] ** 2
-            ).mean()
-            ** 0.5,
-            "crz_gnd_speed": cruise_part["groundspeed"].mean(),
-            "fuel_efficiency_proxy": cruise_part["TAS"].mean()
-            - cruise_part["groundspeed"].mean(),
-        }
-        result.update(cruise_res)
-    return result
-
-
-def process_daily_file(date: datetime.date):
+def process_daily_file(
+    date: datetime.date, flights: pd.DataFrame = None, phase_method=phase_method
+):
     print("Starting with date " + str(date))
     parquet_date = date
     date_str = parquet_date.strftime("%Y-%m-%d")
 
-    flights = load_flights(parquet_date)
+    # Only read the flight list if the caller did not pass the day's slice
+    if flights is None:
+        flights = load_flights(parquet_date)
 
-    # Read the daily flight data
-    parquet = Traffic.from_file(parquet_path + date_str + ".parquet")
+    # Read the needed columns of the flights of this slice only
+    data = read_trajectories(parquet_path + date_str + ".parquet", flights["flight_id"])
 
-    # Initialize computed dataframe
-    computed = pd.DataFrame()
+    # Compute all flights of the day in one pass
+    computed = compute_features(data, flights["flight_id"], phase_method)
 
-    # Process each flight
-    for index, row in flights.iterrows():
-        actual_offblock_time = row["actual_offblock_time"]
-        arrival_time = row["arrival_time"]
-        flight_id = row["flight_id"]
-
-        # Filter records based on flight IDs
-        flight_array = parquet.query(query_str="flight_id == " + str(flight_id) + "")
-
-        if flight_array is None:
-            print("Flight " + str(flight_id) + " not found in " + date_str)
-            res = {"flight_id": flight_id}
-            computed = pd.concat([computed, pd.DataFrame([res])]).reset_index(drop=True)
-            continue
-
-        flight = flight_array[0]
-
-        res = process_one_flight(flight)
-        computed = pd.concat([computed, pd.DataFrame([res])]).reset_index(drop=True)
+    missing = ~flights["flight_id"].isin(data["flight_id"])
+    for flight_id in flights.loc[missing, "flight_id"]:
+        print("Flight " + str(flight_id) + " not found in " + date_str)
 
     return computed
 
 
-def process_all_files(max_workers=None):
+def split_flights(flights: pd.DataFrame, chunks: int):
+    """
+    Split the flights of a day into contiguous chunks of similar size
+    :param flights:
+    :param chunks:
+    :return: list of dataframes
+    """
+    size = max(1, -(-len(flights) // chunks))
+    return [flights.iloc[i : i + size] for i in range(0, max(len(flights), 1), size)]
+
+
+def process_all_files(
+    max_workers=None,
+    force=False,
+    memory_budget=memory_budget,
+    dates=None,
+    chunks=None,
+    phase_method=phase_method,
+):
+    """
+    Process the daily parquet files
+    :param max_workers: number of worker processes
+    :param force: reprocess days that are up to date
+    :param memory_budget: bytes available to all workers together
+    :param dates: dates to process, defaults to all of 2022
+    :param chunks: number of chunks each day is split into, by default days are
+        only split when there are fewer days to process than workers
+    :param phase_method: "traffic" or "fast", see compute_features
+    """
     # Generate a list of dates for the year 2022
-    dates = pd.date_range(start="2022-01-01 00:00Z", end="2022-12-31 00:00Z").tolist()
+    if dates is None:
+        dates = pd.date_range(
+            start="2022-01-01 00:00Z", end="2022-12-31 00:00Z"
+        ).tolist()
 
     # Create the output directory if it doesn't exist
     if not os.path.exists(output_path):
         os.makedirs(output_path)
 
-    # Process the files in parallel
+    # Parse the flight list once, each worker only receives its day
+    flights_per_date = partition_flights()
+    empty = pd.DataFrame(columns=["flight_id", "actual_offblock_time"])
+
+    # Only process new, changed or previously failed days
+    version = FEATURE_VERSION
+    if phase_method != "traffic":
+        version += "+" + phase_method
+    manifest = Manifest(output_path + "manifest.json", version)
+    flights_to_process = {}
+    for date in dates:
+        date_str = date.strftime("%Y-%m-%d")
+        parquet_file = parquet_path + date_str + ".parquet"
+        if not os.path.exists(parquet_file):
+            print(f"No trajectory data for {date}")
+            continue
+        flights = flights_per_date.get(date_str, empty)
+        output_file = output_path + date_str + ".parquet"
+        if not force and manifest.is_current(
+            date_str, parquet_file, flights, output_file
+        ):
+            continue
+        flights_to_process[date] = flights
+    manifest.save()
+    print(f"Processing {len(flights_to_process)} of {len(dates)} days")
+
+    if chunks is None:
+        workers = max_workers or os.cpu_count()
+        chunks = max(1, workers // max(len(flights_to_process), 1))
+
+    # Split the days into chunks of flights processed by separate workers
+    tasks = {}
+    costs = {}
+    chunks_per_date = {}
+    for date, flights in flights_to_process.items():
+        parts = split_flights(flights, chunks)
+        cost = estimate_memory(
+            parquet_path + date.strftime("%Y-%m-%d") + ".parquet", TRAJECTORY_COLUMNS
+        )
+        chunks_per_date[date] = len(parts)
+        for i, part in enumerate(parts):
+            tasks[(date, i)] = (date, part, phase_method)
+            costs[(date, i)] = cost // len(parts)
+
+    # Process the files in parallel, largest days first within the memory budget
+    results = {date: {} for date in flights_to_process}
+    errors = {}
     with ProcessPoolExecutor(max_workers=max_workers) as executor:
-        # Submit each date as a separate task
-        future_to_date = {
-            executor.submit(process_daily_file, date): date for date in dates
-        }
-
         # Collect results as they complete
-        for future in as_completed(future_to_date):
-            date = future_to_date[future]
+        for (date, i), future in submit_bounded(
+            executor, process_daily_file, tasks, costs, memory_budget
+        ):
+            try:
+                results[date][i] = future.result()
+            except Exception as exc:
+                errors[date] = exc
+                results[date][i] = None
+            if len(results[date]) < chunks_per_date[date]:
+                continue
+
+            date_str = date.strftime("%Y-%m-%d")
+            parquet_file = parquet_path + date_str + ".parquet"
+            flights = flights_to_process[date]
+            parts = results.pop(date)
             try:
-                result = future.result()
-                date_str = date.strftime("%Y-%m-%d")
-                result.to_csv(
-                    output_path + date_str + ".csv", mode="w", header=True, index=False
+                if date in errors:
+                    raise errors.pop(date)
+                result = pd.concat(
+                    [parts[i] for i in range(len(parts))], ignore_index=True
                 )
+                # Replace the output only once it is completely written
+                output_file = output_path + date_str + ".parquet"
+                write_features(result, output_file + ".tmp")
+                os.replace(output_file + ".tmp", output_file)
+                manifest.record(date_str, parquet_file, flights)
                 print(f"Completed processing for {date}")
             except Exception as exc:
+                manifest.record(date_str, parquet_file, flights, error=exc)
                 print(f"Processing for {date} generated an exception: {exc}")
 
 
@@ -0,0 +1,268 @@
+import json
+import pickle
+import queue
+import sys
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+import pandas as pd
+
+from create_Xy import build_features, reference, reference_tables, trajectory_features
+
+pipeline_path = "pipeline.pkl"
+batch_size = 64  # flights scored together at most
+max_wait = 0.005  # seconds a flight waits for others to share its batch
+port = 8000
+# Columns of the challenge set the features are computed from, which every
+# record must have
+required_columns = [
+    "flight_id",
+    "date",
+    "adep",
+    "country_code_adep",
+    "ades",
+    "country_code_ades",
+    "actual_offblock_time",
+    "arrival_time",
+    "aircraft_type",
+    "wtc",
+    "airline",
+    "flight_duration",
+    "taxiout_time",
+    "flown_distance",
+]
+
+
+def predict(pipeline, records: list) -> list:
+    """
+    Score flight records with the same feature path as get_data
+    :param pipeline: fitted pipeline
+    :param records: dicts with the columns of the challenge set and the
+        trajectory features of the flight, missing features are NaN
+    :return: list of dicts of flight_id and tow
+    """
+    flights = pd.DataFrame.from_records(records)
+    parquet_data = flights.reindex(columns=["flight_id"] + trajectory_features)
+    parquet_data = parquet_data.astype({col: "float64" for col in trajectory_features})
+    X = build_features(
+        flights.drop(columns=trajectory_features, errors="ignore"), parquet_data
+    )
+    tow = pipeline.predict(X)
+    return [
+        {"flight_id": flight_id, "tow": float(value)}
+        for flight_id, value in zip(flights["flight_id"].tolist(), tow)
+    ]
+
+
+class Scorer:
+    """
+    Scores requests in micro-batches on a background thread, a request waits
+    at most max_wait for others to share its batch
+    """
+
+    def __init__(self, pipeline, batch_size=batch_size, max_wait=max_wait):
+        self.pipeline = pipeline
+        self.batch_size = batch_size
+        self.max_wait = max_wait
+        self.requests = queue.Queue()
+        self.latencies = deque(maxlen=100000)
+        self.batches = deque(maxlen=100000)
+        # Guards latencies and batches, which stats reads from other threads
+        self.lock = threading.Lock()
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def submit(self, records: list) -> Future:
+        """
+        Queue flight records for scoring
+        :param records: list of flight records
+        :return: future of the list of predictions
+        """
+        future = Future()
+        self.requests.put((time.perf_counter(), records, future))
+        return future
+
+    def run(self):
+        while True:
+            batch = [self.requests.get()]
+            try:
+                size = len(batch[0][1])
+                deadline = time.perf_counter() + self.max_wait
+                while size < self.batch_size:
+                    try:
+                        request = self.requests.get(
+                            timeout=max(deadline - time.perf_counter(), 0)
+                        )
+                    except queue.Empty:
+                        break
+                    batch.append(request)
+                    size += len(request[1])
+                self.score(batch)
+            except Exception as exc:
+                # Fail the batch rather than the thread, which serves all requests
+                for _, _, future in batch:
+                    if not future.done():
+                        future.set_exception(exc)
+
+    def score(self, batch: list):
+        records = [record for _, request, _ in batch for record in request]
+        try:
+            predictions = predict(self.pipeline, records)
+        except Exception as exc:
+            if len(batch) == 1:
+                batch[0][2].set_exception(exc)
+                return
+            # Score the requests one by one, so that only invalid ones fail
+            for request in batch:
+                self.score([request])
+            return
+
+        done = time.perf_counter()
+        with self.lock:
+            self.batches.append(len(records))
+            for submitted, _, _ in batch:
+                self.latencies.append(done - submitted)
+        start = 0
+        for _, request, future in batch:
+            future.set_result(predictions[start : start + len(request)])
+            start += len(request)
+
+    def stats(self) -> dict:
+        """
+        Latency of the requests scored so far
+        :return: dict with the number of requests, p50 and p99 latency in
+            milliseconds and the mean batch size
+        """
+        with self.lock:
+            latencies = np.array(self.latencies) * 1000
+            batches = np.array(self.batches)
+        if not len(latencies):
+            return {"requests": 0}
+        return {
+            "requests": len(latencies),
+            "p50_ms": float(np.percentile(latencies, 50)),
+            "p99_ms": float(np.percentile(latencies, 99)),
+            "mean_batch": float(np.mean(batches)),
+        }
+
+
+def parse(body) -> list:
+    """
+    Reads a flight record or a list of them, each with the required columns
+    :param body: JSON text
+    :return: list of dicts
+    """
+    records = json.loads(body)
+    if isinstance(records, dict):
+        records = [records]
+    if not isinstance(records, list) or not all(
+        isinstance(record, dict) for record in records
+    ):
+        raise ValueError("Expected a flight record or a list of flight records")
+    for record in records:
+        missing = [col for col in required_columns if col not in record]
+        if missing:
+            raise ValueError(
+                f"Flight {record.get('flight_id')} misses the columns {missing}"
+            )
+    return records
+
+
+class Handler(BaseHTTPRequestHandler):
+    scorer = None
+
+    def do_POST(self):
+        if self.path != "/predict":
+            self.send_error(404)
+            return
+        try:
+            records = parse(self.rfile.read(int(self.headers["Content-Length"])))
+            self.reply(200, self.scorer.submit(records).result())
+        except Exception as exc:
+            self.reply(400, {"error": str(exc)})
+
+    def do_GET(self):
+        if self.path != "/stats":
+            self.send_error(404)
+            return
+        self.reply(200, self.scorer.stats())
+
+    def reply(self, status: int, content):
+        body = json.dumps(content).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve_http(scorer: Scorer):
+    """
+    Serve POST /predict with a flight record or a list of them, and the latency
+    statistics on GET /stats
+    :param scorer:
+    """
+    Handler.scorer = scorer
+    server = ThreadingHTTPServer(("localhost", port), Handler)
+    print(f"Serving on http://localhost:{port}/predict", file=sys.stderr)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+
+
+def serve_stdin(scorer: Scorer):
+    """
+    Score one flight record, or a list of them, per line of stdin and write one
+    prediction per line to stdout, in input order
+    :param scorer:
+    """
+    pending = queue.Queue()
+
+    def write():
+        while True:
+            future = pending.get()
+            if future is None:
+                return
+            try:
+                predictions = future.result()
+            except Exception as exc:
+                predictions = [{"error": str(exc)}]
+            for prediction in predictions:
+                print(json.dumps(prediction), flush=True)
+
+    writer = threading.Thread(target=write)
+    writer.start()
+    for line in sys.stdin:
+        if not line.strip():
+            continue
+        try:
+            pending.put(scorer.submit(parse(line)))
+        except ValueError as exc:
+            future = Future()
+            future.set_exception(exc)
+            pending.put(future)
+    pending.put(None)
+    writer.join()
+
+
+if __name__ == "__main__":
+    with open(pipeline_path, "rb") as f:
+        pipeline = pickle.load(f)
+    # Read the reference tables before the first request
+    for name in reference_tables:
+        reference(name)
+
+    scorer = Scorer(pipeline)
+    if len(sys.argv) > 1 and sys.argv[1] == "http":
+        serve_http(scorer)
+    else:
+        serve_stdin(scorer)
+    print(json.dumps(scorer.stats()), file=sys.stderr)
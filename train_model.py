@@ -1,14 +1,41 @@
+import copy
+import os
 import pickle
 
 import pandas as pd
+from joblib import Parallel, delayed, parallel_config
 
 from sklearn.ensemble import HistGradientBoostingRegressor
 from sklearn.pipeline import Pipeline
 
+from binned_features import BinnedFeatures, add_trees, clear_trees
 from create_Xy import get_data
 from data_augmentation import get_constructor
 
-# Parameters found using Bayesian optimization with cross-validation, slightly modified
+# Model of get_constructor to the pipeline and the submission written for it
+variants = {
+    "tabular": ("pipeline.pkl", "submission.csv"),
+    "shap": ("pipeline_shap.pkl", "submission_shap.csv"),
+}
+# Variant processes and OpenMP threads per process, together one per core
+n_jobs = len(variants)
+threads_per_job = max(1, os.cpu_count() // n_jobs)
+
+# "full" fits new pipelines on the challenge set, "warm_start" adds trees fitted
+# on the days after the last training day of the stored pipelines to their booster
+mode = "full"
+validation_days = 14  # last days of the training flights held out for early stopping
+n_iter_no_change = 100  # trees without improvement of the validation RMSE
+tol = 0.0  # improvement of the validation RMSE in kg that counts
+# Grow the trees again on all days with the number of trees found, with the
+# encoders and bins fitted on the training days
+refit = True
+warm_start_trees = 1000  # trees added by a warm start at most
+# Trees added without early stopping by a warm start on a single new day
+single_day_trees = 50
+
+# Parameters found using Bayesian optimization with cross-validation, slightly modified.
+# Early stopping is done on the held-out days instead of a random split
 booster = HistGradientBoostingRegressor(
     categorical_features="from_dtype",
     max_bins=255,
@@ -18,28 +45,188 @@ booster = HistGradientBoostingRegressor(
     min_samples_leaf=500,
     l2_regularization=300.0,
     max_depth=1000,
+    early_stopping=False,
     random_state=42,
 )
 
-constructor = get_constructor("tabular")
-pipeline = Pipeline(
-    [
-        ("feature_union", constructor),
-        ("model", booster),
-    ]
-)
-data = get_data("challenge_set")
-X = data.drop("tow", axis=1)
-y = data["tow"]
 
-pipeline.fit(X, y)
+def held_out_days(dates, days: int):
+    """
+    Selects the flights of the last days
+    :param dates: date of every flight
+    :param days: number of days held out
+    :return: boolean series
+    """
+    day = dates.dt.normalize()
+    held_out = day > day.max() - pd.Timedelta(days=days)
+    if held_out.all():
+        raise ValueError(f"No flights before the last {days} days")
+    return held_out
+
+
+def fit(model: str, features, y, dates):
+    """
+    Fits a new pipeline, with as many trees as improve the RMSE on the held-out
+    days
+    :param model: model of get_constructor
+    :param features: output of Augmentation.features for the flights
+    :param y: takeoff weights
+    :param dates: date of every flight
+    :return: fitted pipeline on precomputed features
+    """
+    pipeline = Pipeline(
+        [
+            ("feature_union", get_constructor(model, precomputed=True)),
+            ("model", copy.deepcopy(booster)),
+        ]
+    )
+    val = held_out_days(dates, validation_days)
+    Xt = pipeline[0].fit(features[~val], y[~val]).transform(features)
+    estimator = pipeline[-1].set_params(max_iter=1).fit(Xt[~val], y[~val])
+    # All days are transformed and binned once, for early stopping and the refit
+    binned = BinnedFeatures.from_transformed(pipeline, Xt)
+    del Xt
+    rmse = add_trees(
+        estimator,
+        binned.rows(~val),
+        y[~val],
+        booster.max_iter - 1,
+        binned.rows(val),
+        y[val],
+        n_iter_no_change,
+        tol,
+    )
+    print(
+        f"{model}: {estimator.n_iter_} trees, "
+        f"RMSE {rmse:.1f} on the last {validation_days} days"
+    )
+
+    if refit:
+        n_trees = estimator.n_iter_
+        clear_trees(estimator, y)
+        add_trees(estimator, binned.X_binned, y, n_trees)
+    pipeline.last_day_ = dates.max()
+    return pipeline
+
+
+def warm_start(pipeline, features, y, dates):
+    """
+    Adds trees fitted on the days after the last training day of the pipeline,
+    with the encoders of its Augmentation and booster as they are
+    :param pipeline: pipeline fitted by this script on precomputed features,
+        modified in place
+    :param features: output of Augmentation.features for the flights
+    :param y: takeoff weights
+    :param dates: date of every flight
+    :return: pipeline
+    """
+    last_day = getattr(pipeline, "last_day_", None)
+    if last_day is None:
+        raise ValueError("The pipeline does not record its last training day")
+    new = dates > last_day
+    if not new.any():
+        raise ValueError(f"No flights after {last_day}")
+    features, y, dates = features[new], y[new], dates[new]
+    binned = BinnedFeatures.from_pipeline(pipeline, features)
+
+    estimator = pipeline[-1]
+    initial = copy.deepcopy(estimator)
+    # Hold out fewer days when few new days arrived, at least one is trained on
+    days = min(validation_days, dates.dt.normalize().nunique() - 1)
+    if days == 0:
+        add_trees(estimator, binned.X_binned, y, single_day_trees)
+        print(
+            f"{pipeline[0].model}: {single_day_trees} trees added on {len(y)} "
+            "new flights of a single day"
+        )
+        pipeline.last_day_ = dates.max()
+        return pipeline
+
+    val = held_out_days(dates, days)
+    rmse = add_trees(
+        estimator,
+        binned.rows(~val),
+        y[~val],
+        warm_start_trees,
+        binned.rows(val),
+        y[val],
+        n_iter_no_change,
+        tol,
+    )
+    n_trees = estimator.n_iter_ - initial.n_iter_
+    print(
+        f"{pipeline[0].model}: {n_trees} trees added on {len(y)} new flights, "
+        f"RMSE {rmse:.1f} on the last {days} days"
+    )
+
+    if refit:
+        add_trees(initial, binned.X_binned, y, n_trees)
+        pipeline.steps[-1] = ("model", initial)
+    pipeline.last_day_ = dates.max()
+    return pipeline
+
+
+def train(
+    model: str,
+    pipeline_path: str,
+    submission_path: str,
+    features,
+    y,
+    dates,
+    submission_features,
+    flight_ids,
+):
+    """
+    Fits or warm starts the pipeline of one variant on the shared features and
+    writes it with its submission
+    :param model: model of get_constructor
+    :param pipeline_path: pickle of the pipeline
+    :param submission_path: csv of the predictions for the final submission set
+    :param features: output of Augmentation.features for the challenge set
+    :param y: takeoff weights
+    :param dates: date of every flight
+    :param submission_features: output of Augmentation.features for the final
+        submission set
+    :param flight_ids: flight ids of the final submission set
+    """
+    if mode == "warm_start":
+        with open(pipeline_path, "rb") as f:
+            pipeline = pickle.load(f)
+        pipeline[0].set_params(precomputed=True)
+        warm_start(pipeline, features, y, dates)
+    else:
+        pipeline = fit(model, features, y, dates)
+
+    df = pd.DataFrame()
+    df["tow"] = pipeline.predict(submission_features)
+    df["flight_id"] = flight_ids.to_numpy()
+    df.to_csv(submission_path, index=False)
+
+    # The stored pipeline computes the features of flights as returned by get_data
+    pipeline[0].set_params(precomputed=False)
+    with open(pipeline_path, "wb") as f:
+        pickle.dump(pipeline, f)
+
 
-sub_set = get_data("final_submission_set")
-output = pipeline.predict(sub_set)
-df = pd.DataFrame()
-df["tow"] = output
-df["flight_id"] = sub_set["flight_id"]
-df.to_csv("submission.csv", index=False)
+if __name__ == "__main__":
+    # The features before the airport buckets are the same for all variants
+    constructor = get_constructor("tabular")
+    data = get_data("challenge_set")
+    features = constructor.features(data)
+    sub_set = get_data("final_submission_set")
+    submission_features = constructor.features(sub_set)
 
-with open("pipeline.pkl", "wb") as f:
-    pickle.dump(pipeline, f)
+    with parallel_config("loky", inner_max_num_threads=threads_per_job):
+        Parallel(n_jobs=n_jobs)(
+            delayed(train)(
+                model,
+                pipeline_path,
+                submission_path,
+                features,
+                data["tow"],
+                data["date"],
+                submission_features,
+                sub_set["flight_id"],
+            )
+            for model, (pipeline_path, submission_path) in variants.items()
+        )
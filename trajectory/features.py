@@ -0,0 +1,316 @@
+import numpy as np
+import pandas as pd
+
+from traffic.core import Flight
+
+from trajectory.phases import clean_flights, label_phases
+
+# Bump whenever a change to the feature code alters its output
+FEATURE_VERSION = "2"
+
+# Columns of the per-flight result, in the order produced by process_one_flight
+FEATURE_COLUMNS = [
+    "flight_id",
+    "avg_tas",
+    "avg_wind_u",
+    "avg_wind_v",
+    "climb_rate_mean",
+    "climb_rate_max",
+    "descent_rate_mean",
+    "descent_rate_min",
+    "max_crz_alt",
+    "adsb_inflight_time",
+    "landing_tas",
+    "landing_temp",
+    "dep_temp",
+    "dep_tas",
+    "init_climb_rate",
+    "time_to_10k",
+    "dep_sc",
+    "landing_sc",
+    "climb_efficiency",
+    "climb_in_phases",
+    "cruise_in_phases",
+    "descent_in_phases",
+    "ground_in_phases",
+    "mean_crz_alt",
+    "crz_tas",
+    "crz_wind_u",
+    "crz_wind_v",
+    "crz_wind_tot",
+    "crz_gnd_speed",
+    "fuel_efficiency_proxy",
+]
+
+# Phases with conditional features, in the order of the kernel's phase codes
+PHASE_CODES = ["CLIMB", "DESCENT", "CRUISE", "LEVEL"]
+
+PHASE_FLAGS = {
+    "climb_in_phases": "CLIMB",
+    "cruise_in_phases": "CRUISE",
+    "descent_in_phases": "DESCENT",
+    "ground_in_phases": "GROUND",
+}
+
+
+def prepare_flight(flight: Flight):
+    """
+    Cleans a single flight, computes TAS and phases and resamples it to 10s
+    :param flight:
+    :return: resampled flight and the phases present before filtering
+    """
+    flight_id = flight.flight_id
+    df = flight.data.copy()
+    df.rename(
+        columns={
+            "u_component_of_wind": "wind_u",
+            "v_component_of_wind": "wind_v",
+        },
+        inplace=True,
+    )
+    df.drop_duplicates(inplace=True)
+    df.sort_values(by="timestamp", inplace=True)
+
+    # Create a Flight object from the cleaned dataframe
+    flt = Flight(df)
+
+    try:
+        flt = flt.compute_TAS()
+    except Exception as e:
+        print("Error computing TAS for flight " + str(flight_id), e)
+
+    # Compute the phases of the flight
+    flt = flt.phases()
+    unique_phases = flt.data["phase"].unique()
+
+    # Remove NA and GROUND phases
+    flt.data = flt.data[flt.data["phase"] != "NA"]
+    flt.data = flt.data[flt.data["phase"] != "GROUND"]
+
+    # Resample the data to 10s intervals
+    flt = flt.resample("10s")
+    return flt, unique_phases
+
+
+def prepare_day(data: pd.DataFrame):
+    """
+    Cleans all flights of a day, computes TAS and labels the phases of all
+    flights at once, then resamples every flight to 10s
+    :param data: trajectory data of the day
+    :return: generator of flight id, resampled flight and the phases present
+        before filtering
+    """
+    data = clean_flights(data)
+
+    # Same wind triangle as Flight.compute_TAS
+    tas_x = data["groundspeed"] * np.sin(np.radians(data["track"])) - data["wind_u"]
+    tas_y = data["groundspeed"] * np.cos(np.radians(data["track"])) - data["wind_v"]
+    data["TAS"] = np.abs(tas_x + 1j * tas_y)
+
+    data["phase"] = label_phases(data)
+    unique_phases = data.groupby("flight_id", sort=False)["phase"].unique()
+
+    # Remove NA and GROUND phases
+    data = data[(data["phase"] != "NA") & (data["phase"] != "GROUND")]
+
+    for flight_id, group in data.groupby("flight_id", sort=False):
+        # Resample the data to 10s intervals
+        yield flight_id, Flight(group).resample("10s"), unique_phases[flight_id]
+
+
+def flight_kernel(data: pd.DataFrame) -> dict:
+    """
+    Computes the features of resampled flights over contiguous arrays, every
+    phase-conditional mean comes from a single pass through the phase codes
+    :param data: resampled flights, concatenated flight by flight in time order
+    :return: dict of feature name to array with one value per flight, without
+        the phase flags
+    """
+    n = len(data)
+    flight_id = data["flight_id"].to_numpy()
+    starts = np.flatnonzero(np.r_[True, flight_id[1:] != flight_id[:-1]])
+    ends = np.r_[starts[1:], n]
+    segment = np.repeat(np.arange(len(starts)), ends - starts)
+    row = np.arange(n)
+
+    timestamp = pd.DatetimeIndex(data["timestamp"]).asi8
+    altitude = data["altitude"].to_numpy()
+    vertical_rate = data["vertical_rate"].to_numpy()
+    groundspeed = data["groundspeed"].to_numpy()
+    tas = data["TAS"].to_numpy()
+    wind_u = data["wind_u"].to_numpy()
+    wind_v = data["wind_v"].to_numpy()
+    temperature = data["temperature"].to_numpy()
+    specific_humidity = data["specific_humidity"].to_numpy()
+
+    # One code per row, -1 for phases without conditional features
+    phase = data["phase"].to_numpy()
+    code = np.full(n, -1)
+    for i, name in enumerate(PHASE_CODES):
+        code[phase == name] = i
+    key = segment * len(PHASE_CODES) + code
+    in_phase = code >= 0
+    shape = (len(starts), len(PHASE_CODES))
+    rows = np.bincount(key[in_phase], minlength=np.prod(shape)).reshape(shape)
+
+    def mean(values, mask=None):
+        valid = ~np.isnan(values) if mask is None else mask & ~np.isnan(values)
+        sums = np.bincount(segment[valid], values[valid], len(starts))
+        counts = np.bincount(segment[valid], minlength=len(starts))
+        return sums / np.where(counts > 0, counts, np.nan)
+
+    def phase_mean(values):
+        valid = in_phase & ~np.isnan(values)
+        sums = np.bincount(key[valid], values[valid], np.prod(shape))
+        counts = np.bincount(key[valid], minlength=np.prod(shape))
+        return (sums / np.where(counts > 0, counts, np.nan)).reshape(shape)
+
+    def first_valid(values):
+        # Row of the first non-NaN value of each flight, n if there is none
+        return np.minimum.reduceat(np.where(np.isnan(values), n, row), starts)
+
+    def take(values, index):
+        return np.append(values.astype(np.float64), np.nan)[index]
+
+    # Cruise metrics fall back to the level phase for flights without a cruise
+    has_cruise = rows[:, PHASE_CODES.index("CRUISE")] > 0
+    has_level = rows[:, PHASE_CODES.index("LEVEL")] > 0
+
+    def cruise_mean(values):
+        means = phase_mean(values)
+        return np.where(
+            has_cruise,
+            means[:, PHASE_CODES.index("CRUISE")],
+            means[:, PHASE_CODES.index("LEVEL")],
+        )
+
+    climb = PHASE_CODES.index("CLIMB")
+    descent = PHASE_CODES.index("DESCENT")
+    vertical_rate_means = phase_mean(vertical_rate)
+    groundspeed_means = phase_mean(groundspeed)
+
+    # Time to climb 10,000 feet, from the cumulated altitude gain
+    # NaN rows carry the previous sum, which never moves the first crossing
+    altitude_gain = np.empty(n, dtype=vertical_rate.dtype)
+    for start, end in zip(starts, ends):
+        altitude_gain[start:end] = np.nancumsum(vertical_rate[start:end] / 6)
+    reached_10k = np.minimum.reduceat(np.where(altitude_gain >= 10000, row, n), starts)
+    time_to_10k = np.where(
+        reached_10k < n,
+        (timestamp[np.minimum(reached_10k, n - 1)] - timestamp[starts]) / 1e9 / 60,
+        np.nan,
+    )  # time in minutes
+
+    # Mean climb rate over the first three valid samples
+    first_rate = first_valid(vertical_rate)[segment]
+    initial = (row >= first_rate) & (row < first_rate + 3)
+
+    with np.errstate(invalid="ignore"):
+        result = {
+            "flight_id": flight_id[starts],
+            "avg_tas": mean(tas),
+            "avg_wind_u": mean(wind_u),
+            "avg_wind_v": mean(wind_v),
+            "climb_rate_mean": vertical_rate_means[:, climb],
+            "climb_rate_max": np.fmax.reduceat(
+                np.where(code == climb, vertical_rate, np.nan), starts
+            ),
+            "descent_rate_mean": vertical_rate_means[:, descent],
+            "descent_rate_min": np.fmin.reduceat(
+                np.where(code == descent, vertical_rate, np.nan), starts
+            ),
+            "max_crz_alt": np.fmax.reduceat(altitude, starts) / 100,
+            "adsb_inflight_time": (
+                np.maximum.reduceat(timestamp, starts)
+                - np.minimum.reduceat(timestamp, starts)
+            )
+            / 1e9
+            / 3600,
+            "landing_tas": tas[ends - 1],
+            "landing_temp": temperature[ends - 1],
+            "dep_temp": temperature[starts],
+            "dep_tas": take(tas, first_valid(tas)),
+            "init_climb_rate": mean(vertical_rate, initial),
+            "time_to_10k": time_to_10k,
+            "dep_sc": specific_humidity[starts],
+            "landing_sc": specific_humidity[ends - 1],
+            "climb_efficiency": vertical_rate_means[:, climb]
+            / groundspeed_means[:, climb],
+            "mean_crz_alt": cruise_mean(altitude) / 100,
+            "crz_tas": cruise_mean(tas),
+            "crz_wind_u": cruise_mean(wind_u),
+            "crz_wind_v": cruise_mean(wind_v),
+            "crz_wind_tot": cruise_mean(wind_u**2 + wind_v**2) ** 0.5,
+            "crz_gnd_speed": cruise_mean(groundspeed),
+        }
+    result["fuel_efficiency_proxy"] = result["crz_tas"] - result["crz_gnd_speed"]
+
+    for flight_id in result["flight_id"][~has_cruise & ~has_level]:
+        print("No cruise or level phase found for flight " + str(flight_id))
+    return result
+
+
+def aggregate_flights(data: pd.DataFrame, phases: pd.DataFrame) -> pd.DataFrame:
+    """
+    Computes the features of many resampled flights at once
+    :param data: resampled flights, concatenated flight by flight in time order
+    :param phases: phase flags per flight_id, as built by compute_features
+    :return: dataframe with one row per flight, indexed by flight_id
+    """
+    result = pd.DataFrame(flight_kernel(data)).set_index("flight_id")
+    return result.join(phases)[FEATURE_COLUMNS[1:]]
+
+
+def compute_features(
+    data: pd.DataFrame, flight_ids, phase_method: str = "traffic"
+) -> pd.DataFrame:
+    """
+    Computes the features of all given flights from the data of one day
+    :param data: trajectory data of the day, as read from the daily parquet
+    :param flight_ids: flight ids to compute, in output order
+    :param phase_method: "traffic" to label phases with Flight.phases() per
+        flight, "fast" to label all flights at once with label_phases
+    :return: dataframe with one row per flight id, in the order given
+    """
+    flight_ids = pd.Index(flight_ids)
+    data = data[data["flight_id"].isin(flight_ids)]
+
+    if phase_method == "fast":
+        prepared = prepare_day(data)
+    elif phase_method == "traffic":
+        # Partition the day by flight once instead of querying every flight
+        prepared = (
+            (flight_id, *prepare_flight(Flight(group)))
+            for flight_id, group in data.groupby("flight_id", sort=False)
+        )
+    else:
+        raise ValueError(f"Unknown phase method {phase_method}")
+
+    resampled = []
+    phases = []
+    for flight_id, flt, unique_phases in prepared:
+        # Flights only on the ground or in unknown phases have no rows left,
+        # as in prepare_day they get a row of NaN
+        if flt.data.empty:
+            continue
+        resampled.append(flt.data.assign(flight_id=flight_id))
+        phases.append(
+            {
+                "flight_id": flight_id,
+                **{
+                    flag: int(phase in unique_phases)
+                    for flag, phase in PHASE_FLAGS.items()
+                },
+            }
+        )
+
+    if not resampled:
+        return pd.DataFrame({"flight_id": flight_ids}, columns=FEATURE_COLUMNS)
+
+    result = aggregate_flights(
+        pd.concat(resampled, ignore_index=True),
+        pd.DataFrame(phases).set_index("flight_id"),
+    )
+    result = result.reindex(flight_ids)
+    result.index.name = "flight_id"
+    return result.reset_index()[FEATURE_COLUMNS]
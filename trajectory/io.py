@@ -0,0 +1,93 @@
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from trajectory.features import FEATURE_COLUMNS, PHASE_FLAGS
+
+# Columns of the daily trajectory files used by the feature computation
+TRAJECTORY_COLUMNS = [
+    "flight_id",
+    "timestamp",
+    "altitude",
+    "vertical_rate",
+    "groundspeed",
+    "track",
+    "u_component_of_wind",
+    "v_component_of_wind",
+    "temperature",
+    "specific_humidity",
+]
+
+# Typed schema of the per-flight features written by the trajectory pipeline
+FEATURE_SCHEMA = pa.schema(
+    [
+        (
+            column,
+            (
+                pa.int64()
+                if column == "flight_id"
+                else pa.int8() if column in PHASE_FLAGS else pa.float64()
+            ),
+        )
+        for column in FEATURE_COLUMNS
+    ]
+)
+
+
+def to_table(df: pd.DataFrame) -> pa.Table:
+    """
+    Convert computed features to an arrow table with the feature schema
+    :param df: features, columns missing from df are written as nulls
+    :return: arrow table
+    """
+    columns = [
+        (
+            pa.array(pd.to_numeric(df[field.name]), from_pandas=True).cast(field.type)
+            if field.name in df
+            else pa.nulls(len(df), field.type)
+        )
+        for field in FEATURE_SCHEMA
+    ]
+    return pa.Table.from_arrays(columns, schema=FEATURE_SCHEMA)
+
+
+def write_features(df: pd.DataFrame, path: str):
+    """
+    Write computed features to a parquet file
+    :param df:
+    :param path:
+    """
+    pq.write_table(to_table(df), path)
+
+
+def read_trajectories(
+    parquet_file: str, flight_ids=None, dtype=pa.float32()
+) -> pd.DataFrame:
+    """
+    Read the trajectory columns of the given flights from a daily parquet file
+    :param parquet_file:
+    :param flight_ids: flights to read, pushed down as a row filter, all if None
+    :param dtype: type of the floating point columns
+    :return: dataframe
+    """
+    schema = pq.read_schema(parquet_file)
+    columns = [column for column in TRAJECTORY_COLUMNS if column in schema.names]
+    filters = None
+    if flight_ids is not None:
+        filters = [("flight_id", "in", list(flight_ids))]
+    table = pq.read_table(parquet_file, columns=columns, filters=filters)
+
+    # Narrow the floats before converting, so pandas never holds the wide copy
+    table = table.cast(
+        pa.schema(
+            [
+                (
+                    pa.field(field.name, dtype)
+                    if pa.types.is_floating(field.type)
+                    else field
+                )
+                for field in table.schema
+            ]
+        )
+    )
+    return table.to_pandas()
@@ -0,0 +1,99 @@
+import hashlib
+import json
+import os
+
+import pandas as pd
+
+from trajectory.features import FEATURE_VERSION
+
+
+def file_hash(path: str) -> str:
+    """
+    Compute the sha256 of a file, reading it in chunks
+    :param path:
+    :return: hex digest
+    """
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def flights_hash(flights: pd.DataFrame) -> str:
+    """
+    Compute a hash of the flight ids of a day
+    :param flights:
+    :return: hex digest
+    """
+    flight_ids = pd.Series(sorted(flights["flight_id"]), dtype="int64")
+    return hashlib.sha256(flight_ids.values.tobytes()).hexdigest()
+
+
+class Manifest:
+    """
+    Records the input fingerprint, feature version and status of every
+    processed day, so that reruns only process new, changed or failed days
+    """
+
+    def __init__(self, path: str, version: str = FEATURE_VERSION):
+        self.path = path
+        self.version = version
+        self.entries = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                self.entries = json.load(f)
+
+    def is_current(self, date_str: str, parquet: str, flights: pd.DataFrame, output):
+        """
+        Check whether the output of a day is up to date with its inputs
+        :param date_str:
+        :param parquet: daily trajectory file
+        :param flights: flights of the day
+        :param output: daily feature file
+        :return: bool
+        """
+        entry = self.entries.get(date_str)
+        if entry is None or entry["status"] != "done" or not os.path.exists(output):
+            return False
+        if entry["version"] != self.version:
+            return False
+        if entry["flights"] != flights_hash(flights):
+            return False
+        stat = os.stat(parquet)
+        if entry["size"] != stat.st_size:
+            return False
+        if entry["mtime"] == stat.st_mtime_ns:
+            return True
+        # The file was touched, only its content decides
+        if entry["sha256"] != file_hash(parquet):
+            return False
+        entry["mtime"] = stat.st_mtime_ns
+        return True
+
+    def record(self, date_str: str, parquet: str, flights: pd.DataFrame, error=None):
+        """
+        Record the outcome of processing a day and persist the manifest
+        :param date_str:
+        :param parquet: daily trajectory file
+        :param flights: flights of the day
+        :param error: exception raised while processing, if any
+        """
+        stat = os.stat(parquet)
+        self.entries[date_str] = {
+            "size": stat.st_size,
+            "mtime": stat.st_mtime_ns,
+            "sha256": file_hash(parquet),
+            "flights": flights_hash(flights),
+            "version": self.version,
+            "status": "done" if error is None else "failed",
+            "error": None if error is None else str(error),
+        }
+        self.save()
+
+    def save(self):
+        # Write to a temporary file first so that a crash never corrupts it
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.entries, f, indent=2, sort_keys=True)
+        os.replace(tmp_path, self.path)
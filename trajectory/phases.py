@@ -0,0 +1,219 @@
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+from traffic.core import Flight
+
+# Universes and membership functions of the OpenAP fuzzy phase logic, sampled
+# on the same grids so that interpolated memberships are identical
+alt_range = np.arange(0, 40000, 1)
+roc_range = np.arange(-4000, 4000, 0.1)
+spd_range = np.arange(0, 600, 1)
+states = np.arange(0, 6, 0.01)
+
+LABELS = np.array(["NA", "GROUND", "CLIMB", "DESCENT", "CRUISE", "LEVEL", "NA"])
+
+
+def gaussmf(x, mean, sigma):
+    return np.exp(-((x - mean) ** 2) / (2 * sigma**2))
+
+
+def zmf(x, a, b):
+    y = np.ones(len(x))
+    idx = (a <= x) & (x < (a + b) / 2)
+    y[idx] = 1 - 2 * ((x[idx] - a) / (b - a)) ** 2
+    idx = ((a + b) / 2 <= x) & (x <= b)
+    y[idx] = 2 * ((x[idx] - b) / (b - a)) ** 2
+    y[x >= b] = 0
+    return y
+
+
+def smf(x, a, b):
+    y = np.ones(len(x))
+    y[x <= a] = 0
+    idx = (a <= x) & (x <= (a + b) / 2)
+    y[idx] = 2 * ((x[idx] - a) / (b - a)) ** 2
+    idx = ((a + b) / 2 <= x) & (x <= b)
+    y[idx] = 1 - 2 * ((x[idx] - b) / (b - a)) ** 2
+    return y
+
+
+alt_gnd = zmf(alt_range, 0, 200)
+alt_lo = gaussmf(alt_range, 10000, 10000)
+alt_hi = gaussmf(alt_range, 35000, 20000)
+roc_zero = gaussmf(roc_range, 0, 100)
+roc_plus = smf(roc_range, 10, 1000)
+roc_minus = zmf(roc_range, -1000, -10)
+spd_hi = gaussmf(spd_range, 600, 100)
+spd_md = gaussmf(spd_range, 300, 100)
+spd_lo = gaussmf(spd_range, 0, 50)
+
+# Output state k (1 to 5) is a gaussian centred on k, its right flank is used
+# to find the largest state reaching the aggregated maximum
+state_mf = np.vstack([gaussmf(states, k, 0.1) for k in range(1, 6)])
+state_peak = state_mf.argmax(axis=1)
+state_max = state_mf.max(axis=1)
+
+
+def membership(universe, mf, x):
+    # Values are clipped into the universe first, as OpenAP does
+    return np.interp(np.clip(x, universe[0], universe[-1]), universe, mf)
+
+
+def rule(first, *others):
+    # Python's min() propagates NaN only from its first argument, and a NaN
+    # rule then activates the whole output state
+    fired = np.fmin.reduce([first, *others])
+    return np.where(np.isnan(first), np.inf, fired)
+
+
+def classify(alt, spd, roc):
+    """
+    Fuzzy logic flight phase of many time windows at once
+    :param alt: mean altitude of each window (ft)
+    :param spd: mean ground speed of each window (kt)
+    :param roc: mean vertical rate of each window (ft/min)
+    :return: state codes, 1 to 5 or 6 when no rule fires
+    """
+    alt_level_gnd = membership(alt_range, alt_gnd, alt)
+    alt_level_lo = membership(alt_range, alt_lo, alt)
+    alt_level_hi = membership(alt_range, alt_hi, alt)
+    spd_level_hi = membership(spd_range, spd_hi, spd)
+    spd_level_md = membership(spd_range, spd_md, spd)
+    spd_level_lo = membership(spd_range, spd_lo, spd)
+    roc_level_zero = membership(roc_range, roc_zero, roc)
+    roc_level_plus = membership(roc_range, roc_plus, roc)
+    roc_level_minus = membership(roc_range, roc_minus, roc)
+
+    rules = np.vstack(
+        [
+            rule(alt_level_gnd, roc_level_zero, spd_level_lo),
+            rule(alt_level_lo, roc_level_plus, spd_level_md),
+            rule(alt_level_lo, roc_level_minus, spd_level_md),
+            rule(alt_level_hi, roc_level_zero, spd_level_hi),
+            rule(alt_level_lo, roc_level_zero, spd_level_md),
+        ]
+    )
+
+    # Largest of maximum defuzzification: each state's activation peaks at
+    # min(rule, peak), the result is the largest state value on the grid
+    # where a state reaching the overall maximum stays at or above it
+    activation = np.fmin(rules, state_max[:, None])
+    maximum = activation.max(axis=0)
+    state_raw = np.full(len(alt), -np.inf)
+    for k in range(5):
+        flank = state_mf[k, state_peak[k] :]
+        count = np.searchsorted(-flank, -maximum, side="right")
+        largest = states[state_peak[k] + np.maximum(count, 1) - 1]
+        reaching = activation[k] == maximum
+        state_raw = np.where(reaching, np.maximum(state_raw, largest), state_raw)
+    return np.clip(np.round(state_raw), 1, 6).astype(int)
+
+
+def label_phases(data: pd.DataFrame, twindow: int = 60) -> np.ndarray:
+    """
+    Label the flight phases of all flights of a day at once, following the
+    OpenAP fuzzy logic used by Flight.phases()
+    :param data: trajectories sorted by flight_id, then timestamp
+    :param twindow: time window in seconds
+    :return: array of phase labels
+    """
+    if len(data) == 0:
+        return np.array([], dtype=object)
+
+    flight_id = data["flight_id"].to_numpy()
+    seconds = data["timestamp"].dt.as_unit("s").astype("int64").to_numpy()
+    new_flight = np.r_[True, flight_id[1:] != flight_id[:-1]]
+    flight_start = np.maximum.accumulate(np.where(new_flight, np.arange(len(data)), 0))
+    window = (seconds - seconds[flight_start]) // twindow
+
+    # Windows are contiguous in sorted data
+    starts = np.flatnonzero(new_flight | np.r_[True, window[1:] != window[:-1]])
+    counts = np.diff(np.r_[starts, len(data)])
+
+    def window_mean(column):
+        values = data[column].to_numpy(dtype=np.float64)
+        return np.add.reduceat(values, starts) / counts
+
+    codes = classify(
+        window_mean("altitude"),
+        window_mean("groundspeed"),
+        window_mean("vertical_rate"),
+    )
+
+    # The last window of every flight is left unlabelled
+    last_window = (
+        pd.Series(window[starts]).groupby(flight_start[starts]).transform("max")
+    )
+    codes[window[starts] == last_window.to_numpy()] = 0
+
+    return LABELS[np.repeat(codes, counts)]
+
+
+def clean_flights(data: pd.DataFrame) -> pd.DataFrame:
+    """
+    Rename, deduplicate and sort the trajectories of a day, as prepare_flight
+    does for a single flight
+    :param data:
+    :return: dataframe sorted by flight_id, then timestamp
+    """
+    data = data.rename(
+        columns={
+            "u_component_of_wind": "wind_u",
+            "v_component_of_wind": "wind_v",
+        }
+    )
+    data = data.drop_duplicates()
+    return data.sort_values(["flight_id", "timestamp"], kind="stable").reset_index(
+        drop=True
+    )
+
+
+def agreement_report(data: pd.DataFrame) -> dict:
+    """
+    Compare label_phases with Flight.phases() on the same trajectories
+    :param data: trajectories of a day
+    :return: dict with the overall agreement, the confusion matrix, the
+        agreement per flight and the time spent by both methods
+    """
+    data = clean_flights(data)
+
+    start = time.perf_counter()
+    fast = label_phases(data)
+    fast_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    reference = np.concatenate(
+        [
+            Flight(group).phases().data["phase"].to_numpy()
+            for _, group in data.groupby("flight_id", sort=True)
+        ]
+    )
+    traffic_time = time.perf_counter() - start
+
+    agree = pd.Series(fast == reference)
+    return {
+        "agreement": agree.mean(),
+        "confusion": pd.crosstab(
+            pd.Series(reference, name="traffic"), pd.Series(fast, name="fast")
+        ),
+        "per_flight": agree.groupby(data["flight_id"]).mean(),
+        "traffic_seconds": traffic_time,
+        "fast_seconds": fast_time,
+    }
+
+
+if __name__ == "__main__":
+    report = agreement_report(pd.read_parquet(sys.argv[1]))
+    print(f"Agreement: {report['agreement']:.4%}")
+    print(report["confusion"])
+    print(
+        f"Flights fully in agreement: {(report['per_flight'] == 1).mean():.2%}, "
+        f"worst flight: {report['per_flight'].min():.2%}"
+    )
+    print(
+        f"Flight.phases(): {report['traffic_seconds']:.2f}s, "
+        f"label_phases: {report['fast_seconds']:.2f}s"
+    )
@@ -0,0 +1,54 @@
+from concurrent.futures import FIRST_COMPLETED, wait
+
+import pyarrow.parquet as pq
+
+# Peak memory of a worker relative to the uncompressed size of its day
+MEMORY_FACTOR = 3
+
+
+def estimate_memory(parquet_file: str, columns=None) -> int:
+    """
+    Estimate the peak memory needed to process a daily parquet file from its
+    row group metadata
+    :param parquet_file:
+    :param columns: columns that are read, all if None
+    :return: bytes
+    """
+    metadata = pq.ParquetFile(parquet_file).metadata
+    uncompressed = 0
+    for i in range(metadata.num_row_groups):
+        row_group = metadata.row_group(i)
+        for j in range(row_group.num_columns):
+            column = row_group.column(j)
+            if columns is None or column.path_in_schema in columns:
+                uncompressed += column.total_uncompressed_size
+    return uncompressed * MEMORY_FACTOR
+
+
+def submit_bounded(executor, fn, tasks: dict, costs: dict, budget: int):
+    """
+    Submit tasks largest first while the summed cost of the running tasks
+    stays within the budget, a task larger than the budget runs alone
+    :param executor:
+    :param fn: function to run
+    :param tasks: dict of key to argument tuple
+    :param costs: dict of key to estimated cost
+    :param budget: maximum summed cost of the running tasks
+    :return: generator of (key, future) as the futures complete
+    """
+    pending = sorted(tasks, key=lambda key: costs[key], reverse=True)
+    running = {}
+    used = 0
+    while pending or running:
+        # Fill the budget, smaller tasks may jump ahead of a large one
+        for key in list(pending):
+            if not running or used + costs[key] <= budget:
+                running[executor.submit(fn, *tasks[key])] = key
+                used += costs[key]
+                pending.remove(key)
+
+        done, _ = wait(running, return_when=FIRST_COMPLETED)
+        for future in done:
+            key = running.pop(future)
+            used -= costs[key]
+            yield key, future
@@ -0,0 +1,301 @@
+import functools
+import pickle
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from create_Xy import get_data
+
+pipeline_path = "pipeline.pkl"
+output_path = "shap_values.parquet"
+chunk_size = 256  # rows explained together by a worker
+max_workers = None
+
+
+@functools.lru_cache
+def quadrature(n: int):
+    """
+    Gauss-Legendre rule on [0, 1], exact for polynomials of degree 2n - 1
+    :param n: number of points
+    :return: points and weights
+    """
+    points, weights = np.polynomial.legendre.leggauss(n)
+    return (points + 1) / 2, weights / 2
+
+
+def bitset_table(bitsets):
+    """
+    Expands the category bitsets of a predictor into a lookup table
+    :param bitsets: array of shape (n, 8) of uint32
+    :return: boolean array of shape (n, 256)
+    """
+    bitsets = np.ascontiguousarray(bitsets, dtype="<u4")
+    return np.unpackbits(bitsets.view(np.uint8), axis=1, bitorder="little").astype(bool)
+
+
+class TreePaths:
+    """
+    Arrays of one tree of the booster for the exact path-dependent SHAP values.
+
+    With the cover fraction z and the indicator o of the row following the path
+    for every feature split on the way to a leaf of value v, the SHAP value of
+    feature i for this leaf is v (o_i - z_i) times the integral over [0, 1] of
+    the product of z_j (1 - s) + o_j s over the other features of the path. The
+    products are carried down the tree at the points of a quadrature rule that
+    integrates them exactly, and the leaves are summed up the tree, so a row
+    costs one pass down and one pass up per tree
+    """
+
+    def __init__(self, predictor, known_categories):
+        """
+        :param predictor: TreePredictor of the booster
+        :param known_categories: boolean table of the categories seen in fit,
+            one row per feature of the booster
+        """
+        nodes = predictor.nodes
+        n = len(nodes)
+        is_leaf = nodes["is_leaf"].astype(bool)
+        internal = np.flatnonzero(~is_leaf)
+        left = nodes["left"][internal].astype(np.intp)
+        right = nodes["right"][internal].astype(np.intp)
+        depth = nodes["depth"].astype(np.intp)
+
+        # Splits of the internal nodes, on the features of the booster
+        self.feature = nodes["feature_idx"][internal]
+        self.threshold = nodes["num_threshold"][internal]
+        self.missing_left = nodes["missing_go_to_left"][internal].astype(bool)
+        self.categorical = np.flatnonzero(nodes["is_categorical"][internal])
+        split_nodes = internal[self.categorical]
+        self.left_categories = bitset_table(predictor.raw_left_cat_bitsets)[
+            nodes["bitset_idx"][split_nodes]
+        ]
+        self.known_categories = known_categories[self.feature[self.categorical]]
+
+        # Node n is a sentinel for features not yet split on: o = 1, z = 1
+        self.n = n
+        self.parent = np.full(n, n)
+        self.parent[left] = internal
+        self.parent[right] = internal
+        self.split = np.zeros(n, dtype=np.intp)
+        self.split[left] = np.arange(len(internal))
+        self.split[right] = np.arange(len(internal))
+        self.is_left = np.zeros(n, dtype=bool)
+        self.is_left[left] = True
+        self.left = np.zeros(n, dtype=np.intp)
+        self.right = np.zeros(n, dtype=np.intp)
+        self.left[internal] = left
+        self.right[internal] = right
+
+        # Local feature of the split leading to every node
+        features, local = np.unique(self.feature, return_inverse=True)
+        edge_feature = np.full(n, -1)
+        edge_feature[left] = local
+        edge_feature[right] = local
+
+        # Previous split on the same feature above every node, its cover
+        # fraction and the number of distinct features on the path
+        count = nodes["count"].astype(np.float64)
+        self.levels = [np.flatnonzero(depth == d) for d in range(1, depth.max() + 1)]
+        self.prev = np.full(n + 1, n)
+        self.z = np.ones(n + 1)
+        distinct = np.zeros(n + 1, dtype=np.intp)
+        last = np.full((n + 1, max(len(features), 1)), n)
+        for level in self.levels:
+            parent = self.parent[level]
+            f = edge_feature[level]
+            self.prev[level] = last[parent, f]
+            last[level] = last[parent]
+            last[level, f] = level
+            self.z[level] = self.z[self.prev[level]] * count[level] / count[parent]
+            distinct[level] = distinct[parent] + (self.prev[level] == n)
+
+        # Edges grouped by feature for the sum of their contributions
+        edges = np.arange(1, n)
+        self.edges = edges[np.argsort(edge_feature[edges], kind="stable")]
+        self.starts = np.searchsorted(
+            edge_feature[self.edges], np.arange(len(features))
+        )
+
+        # Splits on the same feature below an edge, to remove from its sum.
+        # Every group subtracts from each edge at most once
+        below = last[internal, local]
+        repeated = np.flatnonzero(below < n)
+        order = repeated[np.argsort(below[repeated], kind="stable")]
+        targets = below[order]
+        rank = np.arange(len(order)) - np.searchsorted(targets, targets)
+        position = np.zeros(n + 1, dtype=np.intp)
+        position[self.edges] = np.arange(len(self.edges))
+        self.repeats = [
+            (internal[order[rank == r]], position[targets[rank == r]])
+            for r in range(rank.max() + 1 if len(order) else 0)
+        ]
+
+        self.internal_levels = [
+            internal[depth[internal] == d] for d in range(depth.max() - 1, -1, -1)
+        ]
+        self.leaves = np.flatnonzero(is_leaf)
+        self.value = nodes["value"][self.leaves]
+        self.expected_value = float(np.sum(self.value * count[self.leaves]) / count[0])
+        self.features = features
+        self.points = max(1, -(-int(distinct[self.leaves].max()) // 2))
+
+    def goes_left(self, X):
+        """
+        Direction taken by the rows at every internal node, as in the raw
+        predictions of the booster
+        :param X: preprocessed rows
+        :return: boolean array of internal nodes by rows
+        """
+        x = X.T[self.feature]
+        missing = np.isnan(x)
+        with np.errstate(invalid="ignore"):
+            left = np.where(
+                missing, self.missing_left[:, None], x <= self.threshold[:, None]
+            )
+        if len(self.categorical):
+            x = x[self.categorical]
+            # Negative and unknown categories are treated as missing
+            invalid = missing[self.categorical] | (x < 0)
+            code = np.where(invalid, 0, x).astype(np.intp)
+            split = np.arange(len(self.categorical))[:, None]
+            in_left = self.left_categories[split, code]
+            known = self.known_categories[split, code]
+            missing_left = self.missing_left[self.categorical, None]
+            left[self.categorical] = np.where(
+                invalid | ~(in_left | known), missing_left, in_left
+            )
+        return left
+
+    def explain(self, X, out):
+        """
+        Adds the SHAP values of this tree to out
+        :param X: preprocessed rows
+        :param out: array of rows by features of the booster
+        """
+        if not len(self.features):
+            return
+        points, weights = quadrature(self.points)
+        left = self.goes_left(X)
+
+        # Down the tree: indicator and product of the factors at every node.
+        # Arrays are node-major, so that a level is a gather of contiguous rows
+        shape = (self.n + 1, len(X), len(points))
+        o = np.ones(shape[:2], dtype=bool)
+        g = np.ones(shape)
+        product = np.ones(shape)
+        for level in self.levels:
+            prev = self.prev[level]
+            o[level] = o[prev] & (left[self.split[level]] == self.is_left[level, None])
+            z = self.z[level, None, None]
+            g[level] = z + (o[level, :, None] - z) * points
+            product[level] = product[self.parent[level]] * g[level] / g[prev]
+
+        # Up the tree: sum of the leaf values weighted by the products
+        total = np.zeros(shape)
+        total[self.leaves] = product[self.leaves] * self.value[:, None, None]
+        for level in self.internal_levels:
+            total[level] = total[self.left[level]] + total[self.right[level]]
+
+        # Contribution of the split leading to every node, summed per feature
+        edges = self.edges
+        own = total[edges]
+        for nodes, positions in self.repeats:
+            own[positions] -= total[nodes]
+        phi = (o[edges] - self.z[edges, None]) * ((own / g[edges]) @ weights)
+        out[:, self.features] += np.add.reduceat(phi, self.starts).T
+
+
+def tree_paths(booster):
+    """
+    Arrays of all trees of a fitted HistGradientBoostingRegressor
+    :param booster:
+    :return: list of TreePaths
+    """
+    n_features = booster.n_features_in_
+    known_categories = np.zeros((n_features, 256), dtype=bool)
+    if booster.is_categorical_ is not None:
+        bitsets, f_idx_map = booster._bin_mapper.make_known_categories_bitsets()
+        categorical = np.flatnonzero(booster._bin_mapper.is_categorical_)
+        known_categories[categorical] = bitset_table(bitsets)[f_idx_map[categorical]]
+    return [
+        TreePaths(predictor, known_categories) for (predictor,) in booster._predictors
+    ]
+
+
+_trees = None
+
+
+def init_worker(trees):
+    global _trees
+    _trees = trees
+
+
+def explain_chunk(X):
+    out = np.zeros(X.shape)
+    for tree in _trees:
+        tree.explain(X, out)
+    return out
+
+
+def shap_values(pipeline, X, chunk_size=chunk_size, max_workers=max_workers):
+    """
+    Exact path-dependent TreeSHAP values of the HistGradientBoostingRegressor
+    at the end of the pipeline, computed from its trees on chunks of rows in
+    worker processes
+    :param pipeline: fitted pipeline
+    :param X: flights as returned by get_data
+    :param chunk_size: number of rows per chunk
+    :param max_workers: number of worker processes
+    :return: dataframe of SHAP values with one column per feature of the
+        booster, and the expected value
+    """
+    booster = pipeline[-1]
+    Xt = pipeline[:-1].transform(X)
+    columns = getattr(Xt, "columns", None)
+    if columns is None:
+        columns = pd.RangeIndex(Xt.shape[1])
+    matrix = booster._preprocess_X(Xt, reset=False)
+
+    # The booster puts the categorical features first
+    if booster.is_categorical_ is None:
+        order = np.arange(matrix.shape[1])
+    else:
+        order = np.r_[
+            np.flatnonzero(booster.is_categorical_),
+            np.flatnonzero(~booster.is_categorical_),
+        ]
+
+    trees = tree_paths(booster)
+    expected_value = float(booster._baseline_prediction[0, 0]) + sum(
+        tree.expected_value for tree in trees
+    )
+
+    chunks = [
+        matrix[start : start + chunk_size]
+        for start in range(0, len(matrix), chunk_size)
+    ]
+    with ProcessPoolExecutor(
+        max_workers, initializer=init_worker, initargs=(trees,)
+    ) as executor:
+        values = np.concatenate(list(executor.map(explain_chunk, chunks)))
+
+    values = pd.DataFrame(values, index=X.index, columns=columns[order])
+    return values[columns], expected_value
+
+
+if __name__ == "__main__":
+    with open(pipeline_path, "rb") as f:
+        pipeline = pickle.load(f)
+    data = get_data("challenge_set")
+    X = data.drop("tow", axis=1)
+
+    start = time.perf_counter()
+    values, expected_value = shap_values(pipeline, X)
+    seconds = time.perf_counter() - start
+    print(
+        f"SHAP values of {len(X)} flights in {seconds:.1f}s, "
+        f"{len(X) / seconds:.1f} flights/s, expected value {expected_value:.1f}"
+    )
+    values.to_parquet(output_path)